@@ -29,7 +29,7 @@ except ImportError:
 
 from xen.xend import XendAPI, XendDomain, XendDomainInfo, XendNode
 from xen.xend import XendLogging, XendDmesg
-from xen.xend import XendDomainGroup
+from xen.xend import XendDomainGroup, XendCheckpointStats
 from xen.xend.XendClient import XML_RPC_SOCKET
 from xen.xend.XendConstants import DOM_STATE_RUNNING
 from xen.xend.XendLogging import log
@@ -48,13 +48,14 @@ def fixup_sxpr(sexpr):
     return ret
 
 #def lookup(domid):
-def lookup dom(domid):
-    info = XendDomain.instance().domain_lookup(domid)
+def lookup_dom(domid, force_refresh = False):
+    info = XendDomain.instance().domain_lookup(domid, force_refresh)
     return info
 
 def dispatch(domid, fn, args):
     #info = lookup(domid)
-    info = lookup_dom(domid)
+    # most dispatched methods change the domain: always look at a fresh view
+    info = lookup_dom(domid, True)
     return getattr(info, fn)(*args)
 
 def domain(domid, full = 0):
@@ -66,7 +67,7 @@ def domain(domid, full = 0):
 #	Lookup Domain Group
 #################################################
 def lookup_grp(dgid):
-    grpinfo = XenDomainGroup.instance().grp_lookup(dgid)
+    grpinfo = XendDomainGroup.instance().grp_lookup(dgid)
     if not grpinfo:
 	raise XendInvalidDomainGroup("Invalid group: %s" % str(dgid))
     return grpinfo
@@ -79,7 +80,7 @@ def group(dgid):
 ##################################################
 #	Create Domain Group
 ##################################################
-def group_create(config)
+def group_create(config):
     info = XendDomainGroup.instance().grp_create(config)
     return info.sxpr()
 
@@ -130,8 +131,9 @@ methods = ['device_create', 'device_configure',
 exclude = ['domain_create', 'domain_restore']
 
 grp_methods = ['grp_destroy', 'grp_pause', 'grp_unpause', 'grp_members',
-	       'grp_join', 'grp_migrate', 'grp_list', 'grp_suspend',
-	       'grp_resume', 'grp_save', 'grp_restore', 'grp_shutdown']
+	       'grp_join', 'grp_migrate', 'grp_migrate_status', 'grp_list',
+	       'grp_suspend', 'grp_resume', 'grp_save', 'grp_restore',
+	       'grp_shutdown', 'grp_catalog']
 
 #####################################################################
 #
@@ -217,14 +219,14 @@ class XMLRPCServer:
             if meth_name[0] != '_':
                 meth = getattr(self.xenapi, meth_name)
                 if callable(meth) and hasattr(meth, 'api'):
-                    self.server.regisregister_instanceter_function(meth, getattr(meth, 'api'))
+                    self.server.register_function(meth, getattr(meth, 'api'))
 
         self.server.register_instance(XendAPI.XendAPIAsyncProxy(self.xenapi))
 
 #########################################################
 #	 Domain Group Operations			#
 #########################################################
-        xdg inst = XendDomainGroup.instance()
+        xdg_inst = XendDomainGroup.instance()
 	for name in grp_methods:
 	    fn = getattr(xdg_inst, name)
 	    self.server.register_function(fn, "xend.group.%s" % name[4:])
@@ -266,6 +268,8 @@ class XMLRPCServer:
         self.server.register_function(domains_with_state,
                                       'xend.domains_with_state')
         self.server.register_function(get_log, 'xend.node.log')
+        self.server.register_function(XendCheckpointStats.get_stats,
+                                      'xend.node.checkpoint_stats')
         self.server.register_function(domain_create, 'xend.domain.create')
         self.server.register_function(domain_restore, 'xend.domain.restore')
 	self.server.register_function(group, 'xend.group')
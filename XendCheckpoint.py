@@ -4,9 +4,12 @@
 #									#
 #########################################################################
 
+import copy
+import errno
 import os
 import os.path
 import re
+import select
 import string
 import threading
 import fcntl
@@ -22,10 +25,17 @@ from xen.xend.XendLogging import log
 from xen.xend.XendConfig import XendConfig
 from xen.xend.XendConstants import *
 from xen.xend import XendNode
-
-SIGNATURE = "LinuxGuestRecord"
+from xen.xend.XendCheckpointStream import CheckpointStream, \
+     CompressFilter, DecompressFilter, parse_compression, COMPRESS_NONE
+from xen.xend import XendCheckpointHeader
+from xen.xend import XendSxp
+from xen.xend.XendCheckpointStats import CheckpointTimer
+from xen.xend.XendCheckpointHeader import CheckpointHeader, \
+     HEADER_SIGNATURE, SECTION_VMCONFIG, SECTION_GRPCONFIG, FEATURE_QEMU_SIZE
+
+SIGNATURE = HEADER_SIGNATURE
 QEMU_SIGNATURE = "QemuDeviceModelRecord"
-dm_batch = 512
+QEMU_SAVE = "/var/lib/xen/qemu-save.%d"
 XC_SAVE = "xc_save"
 XC_RESTORE = "xc_restore"
 
@@ -33,27 +43,52 @@ XC_RESTORE = "xc_restore"
 sizeof_int = calcsize("i")
 sizeof_unsigned_int = calcsize("I")
 sizeof_unsigned_long = calcsize("L")
+sizeof_qemu_size = calcsize("!Q")
 
 
 xc = xen.lowlevel.xc.xc()
 
 
 def write_exact(fd, buf, errmsg):
-    if os.write(fd, buf) != len(buf):
-        raise XendError(errmsg)
+    CheckpointStream(fd).write_exact(buf, errmsg)
 
 
 def read_exact(fd, size, errmsg):
-    buf  = '' 
-    while size != 0: 
-        readstr = os.read(fd, size)
-        if not len(readstr):
-            log.error("read_exact: EOF trying to read %d (buf='%s')" % \
-                      (size, buf))
-            raise XendError(errmsg)
-        size = size - len(readstr)
-        buf  = buf + readstr
-    return buf
+    return CheckpointStream(fd).read_exact(size, errmsg)
+
+
+def stream_position(fd, stream):
+    """Bytes moved through fd so far: its offset for a file, else what
+    went through stream, or None if fd is not seekable and stream is not
+    used, as xc_save and xc_restore use sockets and pipes directly."""
+    try:
+        return os.lseek(fd, 0, 1)
+    except OSError:
+        if stream is None:
+            return None
+        return stream.bytes_read + stream.bytes_written
+
+
+def helper_bytes(fd, stream, position, helper_count):
+    """Bytes xc_save or xc_restore moved through fd since position, from
+    stream_position if it can tell, else helper_count, what the helper
+    itself wrote or read as returned by forkHelper."""
+    if position is not None:
+        return stream_position(fd, stream) - position
+    return helper_count
+
+
+def migrate_devices(dominfo, timer, network, dst, step, domain_name):
+    """Run one device migration step, timing the step as a whole and
+    each device class within it."""
+    phase = 'device_migrate_step%d' % step
+    timer.start(phase)
+    try:
+        results = dominfo.migrateDevices(network, dst, step, domain_name)
+    finally:
+        timer.stop(phase)
+    for r in results or []:
+        timer.add('%s.%s' % (phase, r['member']), r['elapsed_ms'] / 1000.0)
 
 
 def insert_after(list, pred, value):
@@ -65,7 +100,8 @@ def insert_after(list, pred, value):
 #########################################################									
 #		 Save from XendDomain			#
 #########################################################
-def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
+def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1,
+         group_paused=False, compress=None, sender=None):
     from xen.xend import XendDomain
 
     try:
@@ -75,9 +111,12 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
         log.exception("Can't create directory '/var/lib/xen'")
         raise XendError("Can't create directory '/var/lib/xen'")
 
-    write_exact(fd, SIGNATURE, "could not write guest state file: signature")
+    codec, level = parse_compression(compress)
+
+    stream = CheckpointStream(fd)
 
-    sxprep = dominfo.sxpr()
+    # changed below, and dominfo.sxpr() may be shared
+    sxprep = copy.deepcopy(dominfo.sxpr())
 
     if node > -1:
         insert_after(sxprep,'vcpus',['node', str(node)])
@@ -94,7 +133,7 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
             continue
         backend[1] = bkdominfo.getName()
         
-    config = sxp.to_string(sxprep)
+    config = XendSxp.to_string(sxprep)
 
     domain_name = dominfo.getName()
     #
@@ -106,27 +145,41 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
     #
     dominfo.setName('migrating-' + domain_name)
 
-    try:
-        dominfo.migrateDevices(network, dst, DEV_MIGRATE_STEP1, domain_name)
+    if network:
+        timer = CheckpointTimer('migrate', domain_name)
+    else:
+        timer = CheckpointTimer('save', domain_name)
 
-#        write_exact(fd, pack("!i", len(config)),
-#                   "could not write guest state file: config len")
+    try:
+        migrate_devices(dominfo, timer, network, dst, DEV_MIGRATE_STEP1,
+                        domain_name)
 
 #################################################################
 #		     Domains Group				#
 #################################################################
         dgid = dominfo['dgid']
-	xdg = xen.xend.XendDomainGroup.instance()
-	grpinfo = xdg.grp_lookup_nr(dgid)
-	grpconfig = sxp.to_string(grpinfo.sxpr())
-
-        write_exact(fd, pack("!i", len(config)), "could not write guest state file: config len")
-
-        write_exact(fd, config, "could not write guest state file: config")
-
-	write_exact(fd, pack("!i", len(grpconfi)), "could not write group guest state file:")
-	
-	write_exact(fd, grpconfig, "could not write group state file: grpconfig")
+        xdg = xen.xend.XendDomainGroup.instance()
+        grpinfo = xdg.grp_lookup_nr(dgid)
+        grpconfig = XendCheckpointHeader.encode_group_config(grpinfo)
+
+        header = CheckpointHeader({SECTION_VMCONFIG: config,
+                                   SECTION_GRPCONFIG: grpconfig},
+                                  FEATURE_QEMU_SIZE, codec)
+        encoded = header.encode()
+
+        timer.start('header')
+        stream.write_exact(encoded, "could not write guest state file: header")
+        timer.stop('header', len(encoded))
+
+        # everything after the header goes through the compressor, if any
+        if codec == COMPRESS_NONE:
+            compressor = None
+            data_fd = fd
+            data_stream = stream
+        else:
+            compressor = CompressFilter(stream, codec, level)
+            data_fd = compressor.fd
+            data_stream = CheckpointStream(data_fd)
 
         image_cfg = dominfo.info.get('image', {})
         hvm = dominfo.info.is_hvm()
@@ -138,7 +191,7 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
         # enabled. Passing "0" simply uses the defaults compiled into
         # libxenguest; see the comments and/or code in xc_linux_save() for
         # more information.
-        cmd = [xen.util.auxbin.pathTo(XC_SAVE), str(fd),
+        cmd = [xen.util.auxbin.pathTo(XC_SAVE), str(data_fd),
                str(dominfo.getDomid()), "0", "0", 
                str(int(live) | (int(hvm) << 2)) ]
         log.debug("[xc_save]: %s", string.join(cmd))
@@ -148,42 +201,75 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
             if line == "suspend":
                 log.debug("Suspending %d ...", dominfo.getDomid())
                 dominfo.shutdown('suspend')
-                dominfo.waitForSuspend()
+                if group_paused:
+                    # The whole group was paused by a gang checkpoint; let
+                    # this member run just long enough to act on the
+                    # suspend request.
+                    xc.domain_unpause(dominfo.getDomid())
+                latency = dominfo.waitForSuspend()
+                if latency is not None:
+                    timer.add('suspend', latency)
             if line in ('suspend', 'suspended'):
-                dominfo.migrateDevices(network, dst, DEV_MIGRATE_STEP2,
-                                       domain_name)
+                migrate_devices(dominfo, timer, network, dst,
+                                DEV_MIGRATE_STEP2, domain_name)
                 log.info("Domain %d suspended.", dominfo.getDomid())
-                dominfo.migrateDevices(network, dst, DEV_MIGRATE_STEP3,
-                                       domain_name)
+                migrate_devices(dominfo, timer, network, dst,
+                                DEV_MIGRATE_STEP3, domain_name)
                 if hvm:
-                    dominfo.image.saveDeviceModel()
+                    timer.time('save_device_model',
+                               dominfo.image.saveDeviceModel)
 
             if line == "suspend":
                 tochild.write("done\n")
                 tochild.flush()
                 log.debug('Written done')
 
-        forkHelper(cmd, fd, saveInputHandler, False)
-
-        # put qemu device model state
-        if os.path.exists("/var/lib/xen/qemu-save.%d" % dominfo.getDomid()):
-            write_exact(fd, QEMU_SIGNATURE, "could not write qemu signature")
-            qemu_fd = os.open("/var/lib/xen/qemu-save.%d" % dominfo.getDomid(),
-                              os.O_RDONLY)
-            while True:
-                buf = os.read(qemu_fd, dm_batch)
-                if len(buf):
-                    write_exact(fd, buf, "could not write device model state")
-                else:
-                    break
-            os.close(qemu_fd)
-            os.remove("/var/lib/xen/qemu-save.%d" % dominfo.getDomid())
+        try:
+            # the stream only sees what xc_save writes through the
+            # compressor
+            position = stream_position(fd, compressor and stream)
+            timer.start('xc_save')
+            nread, nwritten = forkHelper(cmd, data_fd, saveInputHandler,
+                                         False, timer)
+            timer.stop('xc_save', helper_bytes(fd, stream, position,
+                                               nwritten))
+
+            # put qemu device model state, preceded by its size
+            qemu_path = QEMU_SAVE % dominfo.getDomid()
+            if os.path.exists(qemu_path):
+                qemu_fd = os.open(qemu_path, os.O_RDONLY)
+                try:
+                    qemu_size = os.fstat(qemu_fd).st_size
+                    timer.start('qemu_copy')
+                    data_stream.write_exact(
+                        QEMU_SIGNATURE + pack("!Q", qemu_size),
+                        "could not write qemu signature")
+                    data_stream.send_file(qemu_fd, qemu_size,
+                                          "could not write device model state")
+                    timer.stop('qemu_copy', qemu_size)
+                finally:
+                    os.close(qemu_fd)
+                os.remove(qemu_path)
+        finally:
+            try:
+                if compressor:
+                    compressor.close()
+            finally:
+                # a striped relocation (sender writes fd to the wire) must
+                # have sent everything before the domain is destroyed, so
+                # that a failed connection still leaves it to be resumed
+                if sender:
+                    sender.close()
+
+        log.debug("Save of %s wrote %d bytes of header and device model state",
+                  domain_name, stream.bytes_written)
 
         if checkpoint:
-            dominfo.resumeDomain()
+            timer.time('resume', dominfo.resumeDomain)
         else:
-            dominfo.destroy()
+            timer.time('destroy', dominfo.destroy)
             dominfo.testDeviceComplete()
+        timer.finish(True)
         try:
             dominfo.setName(domain_name, False)
         except VmError:
@@ -196,6 +282,7 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
     except Exception, exn:
         log.exception("Save failed on domain %s (%s) - resuming.", domain_name,
                       dominfo.getDomid())
+        timer.finish(False, exn)
         dominfo.resumeDomain()
  
         try:
@@ -209,6 +296,37 @@ def save(fd, dominfo, network, live, dst, checkpoint=False, node=-1):
 #			  Restore					#
 #########################################################################
 def restore(xd, fd, dominfo = None, paused = False, relocating = False):
+    timer = CheckpointTimer('restore', '')
+    try:
+        timer.start('header')
+        vmconfig, grpconfig, codec = read_header(fd)
+        timer.stop('header')
+        timer.domain = sxp.child_value(vmconfig, 'name')
+        dominfo, restore_image, memory, shadow = \
+                 timer.time('create', restore_create, xd, vmconfig, grpconfig,
+                            dominfo, relocating)
+    except Exception, exn:
+        timer.finish(False, exn)
+        raise
+    try:
+        timer.time('balloon', balloon.free, memory + shadow, dominfo)
+    except Exception, exn:
+        timer.finish(False, exn)
+        dominfo.destroy()
+        log.exception(exn)
+        raise exn
+    return restore_memory(fd, dominfo, restore_image, shadow, paused, codec,
+                          timer)
+
+
+def read_header(fd):
+    """Read the signature, domain config and group config at the start
+    of a save image or migration stream.
+
+    @return: (domain config, group config, compression codec of the rest
+             of the stream)
+    @rtype: tuple
+    """
     try:
         if not os.path.isdir("/var/lib/xen"):
             os.makedirs("/var/lib/xen")
@@ -216,36 +334,38 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
         log.exception("Can't create directory '/var/lib/xen'")
         raise XendError("Can't create directory '/var/lib/xen'")
 
-    signature = read_exact(fd, len(SIGNATURE),
+    stream = CheckpointStream(fd)
+    signature = stream.read_exact(len(SIGNATURE),
         "not a valid guest state file: signature read")
     if signature != SIGNATURE:
         raise XendError("not a valid guest state file: found '%s'" %
                         signature)
 
-#    l = read_exact(fd, sizeof_int, "not a valid guest state file: config size read")
-    vmconfig_size = unpack("!i", l)[0]
-
-    vmconfig_buf = read_exact(fd, vmconfig_size, "not a valid guest state file: config read")
-    
-    l = read_exact(fd, sizeof_int, "not a valid group state file: grpconfig size read")
-    grpconfig_size = unpack("!i", l)[0]
-    grpconfig_buf = read_exact(fd, grpconfig_size, "not a valid group state file: config read")
-
-    p = sxp.Parser()
-    p.input(vmconfig_buf)
-    if not p.ready:
-        raise XendError("not a valid guest state file: config parse")
-
-    vmconfig = p.get_val()
-#########################################################################
-#			  Domains Group					#
-#########################################################################
-    p.reset()
-    p.input(grpconfig_buf)
-    if not p.ready:
-        raise XendError("not a valid group state file: config parse")
-    grpconfig = eval(p.get_val())
-#########################################################################
+    header = XendCheckpointHeader.read_header(stream)
+    for kind in (SECTION_VMCONFIG, SECTION_GRPCONFIG):
+        if kind not in header.sections:
+            raise XendError("not a valid guest state file: no section %d" %
+                            kind)
+    if header.unknown_features():
+        raise XendError("not a valid guest state file: unsupported "
+                        "features 0x%x" % header.unknown_features())
+
+    vmconfig = XendCheckpointHeader.parse_sxp(
+        header.sections[SECTION_VMCONFIG], "config")
+    grpconfig = XendCheckpointHeader.decode_group_config(
+        header.sections[SECTION_GRPCONFIG])
+    codec = header.codec()
+    return vmconfig, grpconfig, codec
+
+
+def restore_create(xd, vmconfig, grpconfig, dominfo = None,
+                   relocating = False):
+    """Create (or resume) the domain described by a save image header and
+    join it to its group, without allocating its memory yet.
+
+    @return: (dominfo, restore image, memory KiB, shadow KiB)
+    @rtype: tuple
+    """
     if not relocating:
         domconfig = XendConfig(sxp_obj = vmconfig)
         othervm = xd.domain_lookup_nr(domconfig["name_label"])
@@ -267,7 +387,7 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
     xdg = xen.xend.XendDomainGroup.instance()
     xdg.domain_groups_lock.acquire()
     try:
-        grpinfo = xdg.grp_lookup(src_dguuid)
+        grpinfo = xdg.grp_lookup(src_dguuid, force_refresh = True)
         if not grpinfo:
             grpcfg = {}
             grpcfg['dguuid'] = src_dguuid
@@ -310,22 +430,6 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
             for v in range(0, dominfo.info['VCPUs_max']):
                  xc.vcpu_setaffinity(dominfo.domid, v, node_to_cpu[nodenr])
 
-    store_port   = dominfo.getStorePort()
-    console_port = dominfo.getConsolePort()
-
-    assert store_port
-    assert console_port
-
-    # if hvm, pass mem size to calculate the store_mfn
-    if is_hvm:
-        apic = int(dominfo.info['platform'].get('apic', 0))
-        pae  = int(dominfo.info['platform'].get('pae',  0))
-        log.info("restore hvm domain %d, apic=%d, pae=%d",
-                 dominfo.domid, apic, pae)
-    else:
-        apic = 0
-        pae  = 0
-
     try:
         restore_image = image.create(dominfo, dominfo.info)
         memory = restore_image.getRequiredAvailableMemory(
@@ -348,30 +452,90 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
         # set memory limit
         xc.domain_setmaxmem(dominfo.getDomid(), maxmem)
 
-        balloon.free(memory + shadow, dominfo)
+        return dominfo, restore_image, memory, shadow
+    except Exception, exn:
+        dominfo.destroy()
+        log.exception(exn)
+        raise exn
+
+
+def restore_memory(fd, dominfo, restore_image, shadow, paused = False,
+                   codec = COMPRESS_NONE, timer = None):
+    """Run xc_restore for a domain set up by L{restore_create}, once the
+    memory it needs has been freed, and bring up its devices.
+
+    @param codec: compression of the stream after the header, as given
+                  by L{read_header}
+    @param timer: CheckpointTimer of the restore so far, if any
+    @rtype: XendDomainInfo
+    """
+    is_hvm = dominfo.info.is_hvm()
+    if timer is None:
+        timer = CheckpointTimer('restore', dominfo.getName())
+
+    store_port   = dominfo.getStorePort()
+    console_port = dominfo.getConsolePort()
 
+    assert store_port
+    assert console_port
+
+    # if hvm, pass mem size to calculate the store_mfn
+    if is_hvm:
+        apic = int(dominfo.info['platform'].get('apic', 0))
+        pae  = int(dominfo.info['platform'].get('pae',  0))
+        log.info("restore hvm domain %d, apic=%d, pae=%d",
+                 dominfo.domid, apic, pae)
+    else:
+        apic = 0
+        pae  = 0
+
+    try:
         shadow_cur = xc.shadow_mem_control(dominfo.getDomid(), shadow / 1024)
         dominfo.info['shadow_memory'] = shadow_cur
 
         superpages = restore_image.superpages
 
-        cmd = map(str, [xen.util.auxbin.pathTo(XC_RESTORE),
-                        fd, dominfo.getDomid(),
-                        store_port, console_port, int(is_hvm), pae, apic, superpages])
-        log.debug("[xc_restore]: %s", string.join(cmd))
-
-        handler = RestoreInputHandler()
-
-        forkHelper(cmd, fd, handler.handler, True)
+        if codec == COMPRESS_NONE:
+            stream = None
+            decompressor = None
+            data_fd = fd
+        else:
+            stream = CheckpointStream(fd)
+            decompressor = DecompressFilter(stream, codec)
+            data_fd = decompressor.fd
 
-        # We don't want to pass this fd to any other children -- we 
-        # might need to recover the disk space that backs it.
         try:
-            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
-            flags |= fcntl.FD_CLOEXEC
-            fcntl.fcntl(fd, fcntl.F_SETFD, flags)
-        except:
-            pass
+            cmd = map(str, [xen.util.auxbin.pathTo(XC_RESTORE),
+                            data_fd, dominfo.getDomid(),
+                            store_port, console_port, int(is_hvm), pae, apic,
+                            superpages])
+            log.debug("[xc_restore]: %s", string.join(cmd))
+
+            handler = RestoreInputHandler()
+
+            position = stream_position(fd, stream)
+            timer.start('xc_restore')
+            nread, nwritten = forkHelper(cmd, data_fd, handler.handler,
+                                         True, timer)
+            timer.stop('xc_restore', helper_bytes(fd, stream, position,
+                                                  nread))
+
+            # We don't want to pass this fd to any other children -- we 
+            # might need to recover the disk space that backs it.
+            try:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+                flags |= fcntl.FD_CLOEXEC
+                fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+            except:
+                pass
+
+            if is_hvm:
+                timer.start('qemu_copy')
+                qemu_size = restore_device_model(data_fd, dominfo.getDomid())
+                timer.stop('qemu_copy', qemu_size)
+        finally:
+            if decompressor:
+                decompressor.close()
 
         if handler.store_mfn is None:
             raise XendError('Could not read store MFN')
@@ -383,7 +547,8 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
 
         # xc_restore will wait for source to close connection
         
-        dominfo.completeRestore(handler.store_mfn, handler.console_mfn)
+        timer.time('complete_restore', dominfo.completeRestore,
+                   handler.store_mfn, handler.console_mfn)
 
         #
         # We shouldn't hold the domains_lock over a waitForDevices
@@ -399,88 +564,192 @@ def restore(xd, fd, dominfo = None, paused = False, relocating = False):
             lock = False;
 
         try:
-            dominfo.waitForDevices() # Wait for backends to set up
+            # Wait for backends to set up
+            timer.time('wait_for_devices', dominfo.waitForDevices)
         finally:
             if lock:
                 XendDomain.instance().domains_lock.acquire()
 
         if not paused:
-            dominfo.unpause()
+            timer.time('unpause', dominfo.unpause)
 
+        timer.finish(True)
         return dominfo
     except Exception, exn:
+        timer.finish(False, exn)
         dominfo.destroy()
         log.exception(exn)
         raise exn
 
 
+def restore_device_model(fd, domid):
+    """Copy the QEMU record that follows the xc_save payload to the file
+    the device model loads its state from.  The record gives its own
+    size, so exactly that much is read.
+    """
+    stream = CheckpointStream(fd)
+    signature = stream.read_exact(len(QEMU_SIGNATURE),
+        "not a valid device model state: signature read")
+    if signature != QEMU_SIGNATURE:
+        raise XendError("not a valid device model state: found '%s'" %
+                        signature)
+    l = stream.read_exact(sizeof_qemu_size,
+        "not a valid device model state: size read")
+    qemu_size = unpack("!Q", l)[0]
+
+    qemu_fd = os.open(QEMU_SAVE % domid,
+                      os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        stream.recv_file(qemu_fd, qemu_size,
+                         "not a valid device model state: state read")
+    finally:
+        os.close(qemu_fd)
+    return qemu_size
+
+
 #########################################################################
 #									#
 #		      Restore Input Handler Class			#
 #									#
 #########################################################################
 class RestoreInputHandler:
+    # control lines of xc_restore, and the attribute each one sets
+    FIELDS = {'store-mfn': 'store_mfn',
+              'console-mfn': 'console_mfn'}
+
     def __init__(self):
         self.store_mfn = None
         self.console_mfn = None
 
 
     def handler(self, line, _):
-        m = re.match(r"^(store-mfn) (\d+)$", line)
-        if m:
-            self.store_mfn = int(m.group(2))
-        else:
-            m = re.match(r"^(console-mfn) (\d+)$", line)
-            if m:
-                self.console_mfn = int(m.group(2))
+        key, _, value = line.partition(' ')
+        field = self.FIELDS.get(key)
+        if field and value.isdigit():
+            setattr(self, field, int(value))
+
+
+# progress lines of xc_save/xc_restore on stderr, as checkpoint events
+PROGRESS_EVENTS = [
+    (re.compile(r"Saving memory pages: iter (\d+)"), 'iteration', ('iter',)),
+    (re.compile(r"(\d+): sent (\d+), skipped (\d+)"), 'iteration_sent',
+     ('iter', 'sent', 'skipped')),
+    (re.compile(r"Total pages sent= (\d+)"), 'total_sent', ('pages',)),
+    (re.compile(r"Reloading memory pages"), 'reload', ()),
+]
+HELPER_ERROR = "ERROR: "
+STDERR_LINE_END = re.compile(r"[\r\n]")
+HELPER_READ_SIZE = 4096
+
+
+class HelperProtocol:
+    """Reads stdout and stderr of xc_save or xc_restore in one thread.
+
+    Lines on stdout are the control channel and go to the input handler.
+    Lines on stderr are logged, and the progress lines among them are
+    added to timer as events.
+    """
+
+    def __init__(self, child, inputHandler, timer = None):
+        self.child = child
+        self.inputHandler = inputHandler
+        self.timer = timer
+        self.handlers = {child.fromchild.fileno(): self.control_line,
+                         child.childerr.fileno(): self.error_line}
+
+    def control_line(self, line):
+        line = line.rstrip()
+        log.debug('%s', line)
+        self.inputHandler(line, self.child.tochild)
+
+    def error_line(self, line):
+        line = line.replace('\b', '').strip()
+        if not line:
+            return
+        if line.startswith(HELPER_ERROR):
+            log.error('%s', line[len(HELPER_ERROR):])
+            return
+        log.info('%s', line)
+        if self.timer:
+            for pattern, event, fields in PROGRESS_EVENTS:
+                m = pattern.search(line)
+                if m:
+                    self.timer.event(event, **dict(zip(fields,
+                                                       map(int, m.groups()))))
+                    break
+
+    def run(self):
+        """Dispatch lines until the child closes both stdout and stderr."""
+        pending = dict([(fd, '') for fd in self.handlers])
+        while pending:
+            try:
+                readable = select.select(pending.keys(), [], [])[0]
+            except select.error, exn:
+                if exn[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in readable:
+                data = os.read(fd, HELPER_READ_SIZE)
+                handler = self.handlers[fd]
+                if not data:
+                    if pending[fd]:
+                        handler(pending[fd])
+                    del pending[fd]
+                    continue
+                if handler == self.control_line:
+                    lines = (pending[fd] + data).split('\n')
+                else:
+                    lines = STDERR_LINE_END.split(pending[fd] + data)
+                pending[fd] = lines.pop()
+                for line in lines:
+                    handler(line)
 
 
-def forkHelper(cmd, fd, inputHandler, closeToChild):
+def helper_io(pid):
+    """@return: (rchar, wchar) of a process from /proc/<pid>/io, the bytes
+    it read and wrote; (0, 0) if they cannot be read.  Must be called
+    before the process is reaped."""
+    counters = {}
+    try:
+        f = open('/proc/%d/io' % pid)
+        try:
+            for line in f:
+                name, value = line.split(':', 1)
+                counters[name] = int(value)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    return counters.get('rchar', 0), counters.get('wchar', 0)
+
+
+def forkHelper(cmd, fd, inputHandler, closeToChild, timer = None):
+    """Run xc_save or xc_restore on fd.
+
+    @return: (read, written), the bytes the helper read and wrote
+    @rtype: tuple
+    """
     child = xPopen3(cmd, True, -1, [fd, xc.handle()])
 
     if closeToChild:
         child.tochild.close()
 
-    thread = threading.Thread(target = slurp, args = (child.childerr,))
-    thread.start()
-
     try:
         try:
-            while 1:
-                line = child.fromchild.readline()
-                if line == "":
-                    break
-                else:
-                    line = line.rstrip()
-                    log.debug('%s', line)
-                    inputHandler(line, child.tochild)
-
-        except IOError, exn:
+            HelperProtocol(child, inputHandler, timer).run()
+        except (IOError, OSError), exn:
             raise XendError('Error reading from child process for %s: %s' %
                             (cmd, exn))
     finally:
         child.fromchild.close()
         if not closeToChild:
             child.tochild.close()
-        thread.join()
         child.childerr.close()
+        io = helper_io(child.pid)
         status = child.wait()
 
     if status >> 8 == 127:
         raise XendError("%s failed: popen failed" % string.join(cmd))
     elif status != 0:
         raise XendError("%s failed" % string.join(cmd))
-
-
-def slurp(infile):
-    while 1:
-        line = infile.readline()
-        if line == "":
-            break
-        else:
-            line = line.strip()
-            m = re.match(r"^ERROR: (.*)", line)
-            if m is None:
-                log.info('%s', line)
-            else:
-                log.error('%s', m.group(1))
+    return io
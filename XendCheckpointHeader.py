@@ -0,0 +1,249 @@
+#########################################################################
+#									#
+#			  Xend Checkpoint Header			#
+#									#
+#########################################################################
+
+"""The header at the start of every save image and migration stream.
+
+    signature      16 bytes, HEADER_SIGNATURE
+    version        !H
+    nr_sections    !H
+    flags          !I   feature flags; the codec sits in bits 8-15
+    table_crc      !I   crc32 of the section table
+    section table  nr_sections * !IQQI (kind, offset, size, crc32)
+    sections       in table order
+
+Offsets count from the first byte of the signature, so a reader of a
+save image can seek straight to the section it wants.  The xc_save
+payload follows the last section.
+"""
+
+import os
+import zlib
+from struct import pack, unpack, calcsize
+
+from xen.xend import sxp
+from xen.xend import XendSxp
+from xen.xend.XendError import XendError
+
+HEADER_SIGNATURE = "LinuxGuestRecHdr"
+HEADER_VERSION = 2
+
+SECTION_VMCONFIG = 1
+SECTION_GRPCONFIG = 2
+
+# the payload after the header is compressed; see XendCheckpointStream
+FEATURE_COMPRESSED = 0x1
+# the QEMU record carries its size after its signature
+FEATURE_QEMU_SIZE = 0x2
+# feature bits this xend understands; bits 8-15 hold the codec
+KNOWN_FEATURES = FEATURE_COMPRESSED | FEATURE_QEMU_SIZE
+FEATURE_MASK = 0xff
+
+# no config section may be larger than this
+MAX_SECTION_SIZE = 4 << 20
+MAX_SECTIONS = 64
+
+HEADER_FIXED = "!HHII"
+SECTION_ENTRY = "!IQQI"
+sizeof_header_fixed = calcsize(HEADER_FIXED)
+sizeof_section_entry = calcsize(SECTION_ENTRY)
+
+
+def crc32(data):
+    return zlib.crc32(data) & 0xffffffff
+
+
+class CheckpointHeader:
+    """The decoded header of a checkpoint stream.
+
+    @ivar version: header version
+    @ivar flags: feature flags
+    @ivar sections: section data by kind, for the sections that were read
+    @ivar table: (offset, size, crc) by kind, for every section
+    @ivar size: length of the whole header, i.e. offset of the payload
+    """
+
+    def __init__(self, sections = None, flags = 0, codec = 0):
+        self.version = HEADER_VERSION
+        self.flags = flags | (codec << 8)
+        if codec:
+            self.flags |= FEATURE_COMPRESSED
+        self.sections = sections or {}
+        self.table = {}
+        self.size = 0
+
+    def unknown_features(self):
+        return self.flags & FEATURE_MASK & ~KNOWN_FEATURES
+
+    def codec(self):
+        if self.flags & FEATURE_COMPRESSED:
+            return (self.flags >> 8) & 0xff
+        return 0
+
+    def encode(self):
+        """@return: the header as written to the stream
+        @rtype: string
+        """
+        kinds = self.sections.keys()
+        kinds.sort()
+        offset = len(HEADER_SIGNATURE) + sizeof_header_fixed + \
+                 len(kinds) * sizeof_section_entry
+        table = []
+        for kind in kinds:
+            data = self.sections[kind]
+            table.append(pack(SECTION_ENTRY, kind, offset, len(data),
+                              crc32(data)))
+            self.table[kind] = (offset, len(data), crc32(data))
+            offset += len(data)
+        self.size = offset
+        table = "".join(table)
+        return "".join([HEADER_SIGNATURE,
+                        pack(HEADER_FIXED, self.version, len(kinds),
+                             self.flags, crc32(table)),
+                        table] +
+                       [self.sections[kind] for kind in kinds])
+
+    def _decode_table(self, read):
+        fixed = read(sizeof_header_fixed, "header read")
+        self.version, nr_sections, self.flags, table_crc = \
+                      unpack(HEADER_FIXED, fixed)
+        if self.version != HEADER_VERSION:
+            raise XendError("unsupported checkpoint header version %d" %
+                            self.version)
+        if nr_sections > MAX_SECTIONS:
+            raise XendError("corrupt checkpoint header: %d sections" %
+                            nr_sections)
+        table = read(nr_sections * sizeof_section_entry, "section table read")
+        if crc32(table) != table_crc:
+            raise XendError("corrupt checkpoint header: section table "
+                            "checksum")
+
+        entries = []
+        self.size = len(HEADER_SIGNATURE) + sizeof_header_fixed + len(table)
+        for i in range(nr_sections):
+            kind, offset, size, crc = \
+                  unpack(SECTION_ENTRY, table[i * sizeof_section_entry:
+                                              (i + 1) * sizeof_section_entry])
+            if size > MAX_SECTION_SIZE or offset < self.size:
+                raise XendError("corrupt checkpoint header: section %d at "
+                                "%d, size %d" % (kind, offset, size))
+            self.table[kind] = (offset, size, crc)
+            entries.append((offset, kind))
+        entries.sort()
+        if entries:
+            offset, kind = entries[-1]
+            self.size = offset + self.table[kind][1]
+        return entries
+
+    def _check(self, kind, data):
+        if crc32(data) != self.table[kind][2]:
+            raise XendError("corrupt checkpoint header: section %d checksum"
+                            % kind)
+        self.sections[kind] = data
+
+
+def read_header(stream):
+    """Read a whole header from a stream positioned just after the
+    signature, leaving the stream at the start of the payload.
+
+    @type stream: XendCheckpointStream.CheckpointStream
+    @rtype: CheckpointHeader
+    """
+    def read(size, what):
+        return stream.read_exact(size, "not a valid guest state file: %s" %
+                                 what)
+
+    header = CheckpointHeader()
+    pos = len(HEADER_SIGNATURE) + sizeof_header_fixed
+    entries = header._decode_table(read)
+    pos += len(entries) * sizeof_section_entry
+    for offset, kind in entries:
+        if offset < pos:
+            raise XendError("corrupt checkpoint header: overlapping "
+                            "sections")
+        if offset > pos:
+            read(offset - pos, "section padding read")
+        size = header.table[kind][1]
+        header._check(kind, read(size, "section %d read" % kind))
+        pos = offset + size
+    return header
+
+
+def read_image_header(path, kinds = None):
+    """Read the header of a save image, seeking past the sections that are
+    not wanted and never touching the payload.
+
+    @param kinds: section kinds to read, None for all of them
+    @rtype: CheckpointHeader
+    @raise XendError: not a save image with a versioned header
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        def read(size, what):
+            buf = os.read(fd, size)
+            if len(buf) != size:
+                raise XendError("%s: truncated checkpoint header (%s)" %
+                                (path, what))
+            return buf
+
+        if read(len(HEADER_SIGNATURE), "signature read") != HEADER_SIGNATURE:
+            raise XendError("%s: not a versioned save image" % path)
+        header = CheckpointHeader()
+        for offset, kind in header._decode_table(read):
+            if kinds is not None and kind not in kinds:
+                continue
+            os.lseek(fd, offset, 0)
+            header._check(kind, read(header.table[kind][1],
+                                     "section %d read" % kind))
+        return header
+    finally:
+        os.close(fd)
+
+
+#########################################################################
+#			  Config sections				#
+#########################################################################
+def parse_sxp(data, what):
+    """Parse one bounded sxp section.  Nothing in it is evaluated."""
+    if len(data) > MAX_SECTION_SIZE:
+        raise XendError("not a valid guest state file: %s too large" % what)
+    try:
+        values = XendSxp.parse(data)
+    except XendError:
+        values = None
+    if not values:
+        raise XendError("not a valid guest state file: %s parse" % what)
+    return values[0]
+
+
+def encode_group_config(grpinfo):
+    """@return: the group section for a XendDomainGroupInfo
+    @rtype: string
+    """
+    return XendSxp.to_string(['domain_group',
+                              ['dgid', grpinfo.dgid],
+                              ['dguuid', grpinfo.dguuid],
+                              ['grp_name', grpinfo.grp_name],
+                              ['member_list'] + list(grpinfo.members)])
+
+
+def decode_group_config(data):
+    """@return: the group section as a dict with the dgid, dguuid,
+                grp_name and member_list of the saved group
+    @rtype: dict
+    """
+    config = parse_sxp(data, "group config")
+    if not isinstance(config, list) or not config or \
+       config[0] != 'domain_group':
+        raise XendError("not a valid group state file: config parse")
+    members = sxp.child(config, 'member_list') or ['member_list']
+    try:
+        dgid = int(sxp.child_value(config, 'dgid'))
+    except (TypeError, ValueError):
+        raise XendError("not a valid group state file: dgid")
+    return {'dgid': dgid,
+            'dguuid': sxp.child_value(config, 'dguuid'),
+            'grp_name': sxp.child_value(config, 'grp_name'),
+            'member_list': members[1:]}
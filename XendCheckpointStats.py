@@ -0,0 +1,145 @@
+#########################################################################
+#									#
+#			  Xend Checkpoint Stats				#
+#									#
+#########################################################################
+
+"""Phase timings of save, restore and migrate operations.
+
+Every operation records how long each of its phases took and how many
+bytes it moved; the last xend-checkpoint-stats-history operations are
+kept and exported as xend.node.checkpoint_stats.
+"""
+
+import threading
+import time
+
+from xen.xend import XendOptions
+from xen.xend.XendLogging import log
+
+DEFAULT_HISTORY = 32
+# events kept per operation
+MAX_EVENTS = 256
+
+xoptions = XendOptions.instance()
+
+_history = []
+_lock = threading.Lock()
+
+
+def _history_size():
+    return max(1, xoptions.get_config_int('xend-checkpoint-stats-history',
+                                          DEFAULT_HISTORY))
+
+
+def _rate(nbytes, seconds):
+    if nbytes and seconds > 0:
+        return round(nbytes / seconds / (1 << 20), 2)
+    return 0.0
+
+
+class CheckpointTimer:
+    """Times the phases of one save, restore or migration.
+
+    @ivar op: 'save', 'migrate' or 'restore'
+    @ivar domain: name of the domain
+    @ivar phases: list of phase records, in the order they ended
+    @ivar events: progress events reported by xc_save/xc_restore
+    """
+
+    def __init__(self, op, domain):
+        self.op = op
+        self.domain = domain
+        self.started = time.time()
+        self.phases = []
+        self.events = []
+        self._running = {}
+        self._lock = threading.Lock()
+        self.finished = False
+
+    def start(self, phase):
+        self._running[phase] = time.time()
+
+    def stop(self, phase, nbytes = 0):
+        started = self._running.pop(phase, None)
+        if started is not None:
+            self.add(phase, time.time() - started, nbytes)
+
+    def add(self, phase, seconds, nbytes = 0):
+        record = {'phase': phase,
+                  'elapsed_ms': int(seconds * 1000),
+                  'kbytes': int(nbytes / 1024),
+                  'mb_per_s': _rate(nbytes, seconds)}
+        self._lock.acquire()
+        try:
+            self.phases.append(record)
+        finally:
+            self._lock.release()
+
+    def event(self, event, **fields):
+        """Record a progress event, e.g. the start of a pre-copy round."""
+        if len(self.events) >= MAX_EVENTS:
+            return
+        fields['event'] = event
+        fields['at_ms'] = int((time.time() - self.started) * 1000)
+        self.events.append(fields)
+
+    def time(self, phase, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) as the given phase."""
+        self.start(phase)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.stop(phase)
+
+    def finish(self, ok, error = ''):
+        """Close the operation and add it to the history."""
+        if self.finished:
+            return
+        self.finished = True
+        elapsed = time.time() - self.started
+        record = {'op': self.op,
+                  'domain': self.domain,
+                  'started': int(self.started),
+                  'elapsed_ms': int(elapsed * 1000),
+                  'ok': bool(ok),
+                  'error': str(error),
+                  'phases': list(self.phases),
+                  'events': list(self.events)}
+        log.info("%s of %s %s in %dms: %s", self.op, self.domain,
+                 ok and "done" or "failed", record['elapsed_ms'],
+                 ", ".join(["%s %dms" % (p['phase'], p['elapsed_ms'])
+                            for p in self.phases]))
+        _lock.acquire()
+        try:
+            _history.append(record)
+            del _history[:-_history_size()]
+        finally:
+            _lock.release()
+
+
+def get_stats(op = None):
+    """Return the recent operations and, per phase, how often it ran and
+    its mean and worst time, so the dominant phase stands out.
+
+    @param op: only operations of this kind
+    @rtype: dict
+    """
+    _lock.acquire()
+    try:
+        history = [r for r in _history if op is None or r['op'] == op]
+    finally:
+        _lock.release()
+
+    phases = {}
+    for record in history:
+        for p in record['phases']:
+            total = phases.setdefault(p['phase'], {'count': 0,
+                                                   'total_ms': 0,
+                                                   'max_ms': 0})
+            total['count'] += 1
+            total['total_ms'] += p['elapsed_ms']
+            total['max_ms'] = max(total['max_ms'], p['elapsed_ms'])
+    for total in phases.values():
+        total['mean_ms'] = total['total_ms'] / total['count']
+    return {'history': history, 'phases': phases}
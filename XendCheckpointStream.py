@@ -0,0 +1,398 @@
+#########################################################################
+#									#
+#			  Xend Checkpoint Stream			#
+#									#
+#########################################################################
+
+"""Exact-length reads and writes on checkpoint streams: save images, and
+the relocation sockets and pipes that carry migrations.
+
+The stream fd is shared with xc_save/xc_restore, so nothing here reads
+ahead or holds back writes: every call moves exactly the bytes asked for,
+straight between the fd and the caller's buffer.
+"""
+
+import errno
+import io
+import os
+import stat
+import threading
+import zlib
+from struct import pack, unpack, calcsize
+
+from xen.xend import XendOptions
+from xen.xend.XendError import XendError
+from xen.xend.XendLogging import log
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno = True)
+    _sendfile = _libc.sendfile
+    _sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                          ctypes.c_size_t]
+    _sendfile.restype = ctypes.c_ssize_t
+    _splice = _libc.splice
+    _splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                        ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    _splice.restype = ctypes.c_ssize_t
+except (ImportError, OSError, AttributeError):
+    _sendfile = None
+    _splice = None
+
+# largest single kernel copy, and buffer size of the fallback copy
+COPY_CHUNK = 1 << 20
+
+# stream compression codecs, as recorded in the checkpoint header
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZ4 = 2
+
+COMPRESS_NAMES = {'none': COMPRESS_NONE,
+                  'zlib': COMPRESS_ZLIB,
+                  'lz4':  COMPRESS_LZ4}
+
+COMPRESS_DEFAULT_LEVELS = {COMPRESS_ZLIB: 1,
+                           COMPRESS_LZ4: 0}
+
+sizeof_frame_len = calcsize("!I")
+
+xoptions = XendOptions.instance()
+
+
+class CheckpointStream:
+    """Wraps a checkpoint stream fd and counts the bytes xend moves on it.
+
+    @ivar fd: the stream file descriptor; not closed by this object
+    @ivar bytes_read: bytes read through this stream
+    @ivar bytes_written: bytes written through this stream
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.raw = io.FileIO(fd, 'r+', closefd = False)
+
+    def readinto(self, buf, errmsg):
+        """Fill all of buf (a bytearray or writable memoryview).
+
+        @raise XendError: EOF or an error before buf was filled
+        """
+        view = memoryview(buf)
+        size = len(view)
+        got = 0
+        while got < size:
+            try:
+                n = self.raw.readinto(view[got:])
+            except IOError, exn:
+                if exn.errno == errno.EINTR:
+                    continue
+                log.error("read_exact: %s after %d of %d bytes", exn, got,
+                          size)
+                raise XendError(errmsg)
+            if not n:
+                log.error("read_exact: EOF trying to read %d (got %d)",
+                          size, got)
+                raise XendError(errmsg)
+            got += n
+        self.bytes_read += size
+        return size
+
+    def read_exact(self, size, errmsg):
+        """Read exactly size bytes.
+
+        @rtype: string
+        @raise XendError: EOF or an error before size bytes were read
+        """
+        buf = bytearray(size)
+        self.readinto(buf, errmsg)
+        return str(buf)
+
+    def write_exact(self, buf, errmsg):
+        """Write all of buf, retrying short writes.
+
+        @raise XendError: the fd refused to take the rest of buf
+        """
+        size = self._write_all(buf, errmsg)
+        self.bytes_written += size
+        return size
+
+    def _write_all(self, buf, errmsg):
+        view = memoryview(buf)
+        size = len(view)
+        done = 0
+        while done < size:
+            try:
+                n = self.raw.write(view[done:])
+            except IOError, exn:
+                if exn.errno == errno.EINTR:
+                    continue
+                log.error("write_exact: %s after %d of %d bytes", exn, done,
+                          size)
+                raise XendError(errmsg)
+            if not n:
+                log.error("write_exact: no progress after %d of %d bytes",
+                          done, size)
+                raise XendError(errmsg)
+            done += n
+        return size
+
+    def send_file(self, in_fd, size, errmsg):
+        """Write size bytes of the regular file in_fd, from its current
+        offset, to the stream.
+
+        The copy stays in the kernel where it can: sendfile(2) to sockets
+        and files, splice(2) to pipes.  Otherwise, or if the kernel
+        refuses, the rest goes through a COPY_CHUNK sized buffer.
+
+        @raise XendError: in_fd ended early or the stream failed
+        """
+        if stat.S_ISFIFO(os.fstat(self.fd).st_mode):
+            kernel_copy = _splice and self._splice_from
+        elif hasattr(os, 'sendfile'):
+            kernel_copy = self._os_sendfile_from
+        else:
+            kernel_copy = _sendfile and self._sendfile_from
+
+        done = 0
+        while kernel_copy and done < size:
+            try:
+                n = kernel_copy(in_fd, min(size - done, COPY_CHUNK))
+            except OSError, exn:
+                if exn.errno == errno.EINTR:
+                    continue
+                if exn.errno in (errno.EINVAL, errno.ENOSYS):
+                    log.debug("Kernel copy unavailable (%s), buffering", exn)
+                    break
+                log.error("send_file: %s after %d of %d bytes", exn, done,
+                          size)
+                raise XendError(errmsg)
+            if not n:
+                log.error("send_file: EOF after %d of %d bytes", done, size)
+                raise XendError(errmsg)
+            done += n
+
+        if done < size:
+            src = io.FileIO(in_fd, 'r', closefd = False)
+            buf = bytearray(min(size - done, COPY_CHUNK))
+            view = memoryview(buf)
+            while done < size:
+                n = src.readinto(view[:min(size - done, len(buf))])
+                if not n:
+                    log.error("send_file: EOF after %d of %d bytes", done,
+                              size)
+                    raise XendError(errmsg)
+                self._write_all(view[:n], errmsg)
+                done += n
+
+        self.bytes_written += size
+        return size
+
+    def recv_file(self, out_fd, size, errmsg):
+        """Read exactly size bytes from the stream into out_fd.
+
+        @raise XendError: the stream ended early or out_fd failed
+        """
+        dst = io.FileIO(out_fd, 'w', closefd = False)
+        buf = bytearray(min(size, COPY_CHUNK))
+        view = memoryview(buf)
+        done = 0
+        while done < size:
+            n = min(size - done, len(buf))
+            self.readinto(view[:n], errmsg)
+            written = 0
+            while written < n:
+                written += dst.write(view[written:n])
+            done += n
+        return size
+
+    def _os_sendfile_from(self, in_fd, count):
+        return os.sendfile(self.fd, in_fd, None, count)
+
+    def _sendfile_from(self, in_fd, count):
+        n = _sendfile(self.fd, in_fd, None, count)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+    def _splice_from(self, in_fd, count):
+        n = _splice(in_fd, None, self.fd, None, count, 0)
+        if n < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return n
+
+
+#########################################################################
+#			  Stream compression				#
+#########################################################################
+def compression_available(codec):
+    return codec in (COMPRESS_NONE, COMPRESS_ZLIB) or \
+           (codec == COMPRESS_LZ4 and lz4 is not None)
+
+
+def parse_compression(spec = None):
+    """Turn a compression spec into (codec, level).
+
+    The spec is 'none', 'zlib', 'lz4', optionally followed by ':level';
+    None means the xend-checkpoint-compression option.  lz4 falls back to
+    zlib where the lz4 module is not installed.
+
+    @rtype: tuple
+    @raise XendError: unknown codec or level
+    """
+    if spec is None:
+        spec = xoptions.get_config_string('xend-checkpoint-compression',
+                                          'none')
+    name, _, level = str(spec).partition(':')
+    codec = COMPRESS_NAMES.get(name.strip().lower())
+    if codec is None:
+        raise XendError("Unknown checkpoint compression '%s'" % spec)
+    if codec == COMPRESS_LZ4 and not compression_available(codec):
+        log.warn("lz4 module not available, compressing with zlib")
+        codec = COMPRESS_ZLIB
+        level = ''
+    if level:
+        try:
+            level = int(level)
+        except ValueError:
+            raise XendError("Bad checkpoint compression level '%s'" % spec)
+    else:
+        level = COMPRESS_DEFAULT_LEVELS.get(codec, 0)
+    return codec, level
+
+
+class _Lz4Compressor:
+    def __init__(self, level):
+        self.lz4 = lz4.frame.LZ4FrameCompressor(compression_level = level)
+        self.pending = self.lz4.begin()
+
+    def compress(self, data):
+        out = self.pending + self.lz4.compress(data)
+        self.pending = ''
+        return out
+
+    def flush(self):
+        return self.pending + self.lz4.flush()
+
+
+class _Lz4Decompressor:
+    def __init__(self):
+        self.lz4 = lz4.frame.LZ4FrameDecompressor()
+
+    def decompress(self, data):
+        return self.lz4.decompress(data)
+
+    def flush(self):
+        return ''
+
+
+def _compressor(codec, level):
+    if codec == COMPRESS_ZLIB:
+        return zlib.compressobj(level)
+    return _Lz4Compressor(level)
+
+
+def _decompressor(codec):
+    if not compression_available(codec):
+        raise XendError("Checkpoint stream compressed with unsupported "
+                        "codec %d" % codec)
+    if codec == COMPRESS_ZLIB:
+        return zlib.decompressobj()
+    return _Lz4Decompressor()
+
+
+class _PipeFilter:
+    """Runs a filter thread between a pipe and a checkpoint stream.
+
+    @ivar fd: the pipe end to hand to xc_save/xc_restore
+    """
+
+    def __init__(self, fd, other_fd):
+        self.fd = fd
+        self.other_fd = other_fd
+        self.error = None
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            try:
+                self.filter(self.other_fd)
+            except Exception, exn:
+                log.exception("Checkpoint stream filter failed")
+                self.error = exn
+        finally:
+            os.close(self.other_fd)
+
+    def close(self):
+        """Close our pipe end and wait for the filter to finish.
+
+        @raise XendError: the filter failed
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.thread.join()
+        if self.error:
+            raise XendError("Checkpoint stream filter failed: %s" %
+                            self.error)
+
+
+class CompressFilter(_PipeFilter):
+    """Compresses everything written to fd onto stream, as length-prefixed
+    frames ending with an empty frame.
+    """
+
+    def __init__(self, stream, codec, level):
+        self.stream = stream
+        self.compressor = _compressor(codec, level)
+        r, w = os.pipe()
+        _PipeFilter.__init__(self, w, r)
+
+    def _frame(self, data):
+        if data:
+            self.stream.write_exact(pack("!I", len(data)) + data,
+                                    "could not write compressed frame")
+
+    def filter(self, r):
+        while True:
+            buf = os.read(r, COPY_CHUNK)
+            if not buf:
+                break
+            self._frame(self.compressor.compress(buf))
+        self._frame(self.compressor.flush())
+        self.stream.write_exact(pack("!I", 0),
+                                "could not write compressed stream end")
+
+
+class DecompressFilter(_PipeFilter):
+    """Feeds the decompressed frames of stream into the pipe read at fd."""
+
+    def __init__(self, stream, codec):
+        self.stream = stream
+        self.decompressor = _decompressor(codec)
+        r, w = os.pipe()
+        _PipeFilter.__init__(self, r, w)
+
+    def filter(self, w):
+        out = CheckpointStream(w)
+        while True:
+            l = self.stream.read_exact(sizeof_frame_len,
+                                       "compressed frame length read")
+            size = unpack("!I", l)[0]
+            if not size:
+                break
+            data = self.stream.read_exact(size, "compressed frame read")
+            out.write_exact(self.decompressor.decompress(data),
+                            "could not pass on decompressed data")
+        out.write_exact(self.decompressor.flush(),
+                        "could not pass on decompressed data")
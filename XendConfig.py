@@ -18,6 +18,7 @@ from xen.xend import sxp
 from xen.xend import uuid
 from xen.xend import XendOptions
 from xen.xend import XendAPIStore
+from xen.xend import XendSxp
 from xen.xend.XendPPCI import XendPPCI
 from xen.xend.XendDPCI import XendDPCI
 from xen.xend.XendPSCSI import XendPSCSI
@@ -339,8 +340,11 @@ class XendConfig(dict):
         
         if filename:
             try:
-                sxp_obj = sxp.parse(open(filename,'r'))
-                sxp_obj = sxp_obj[0]
+                f = open(filename,'r')
+                try:
+                    sxp_obj = XendSxp.parse(f.read())[0]
+                finally:
+                    f.close()
             except IOError, e:
                 raise XendConfigError("Unable to read file: %s" % filename)
         
@@ -375,6 +379,29 @@ class XendConfig(dict):
             dict.__setitem__(self, key, value)
     """
 
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed()
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed()
+
+    def __getstate__(self):
+        # snapshots are rebuilt rather than pickled
+        state = self.__dict__.copy()
+        state.pop('_sxp_snapshots', None)
+        return state
+
+    def changed(self):
+        """Note a change to the configuration, so that the snapshots of
+        to_sxp_snapshot() are rebuilt.  Item assignment calls this; code
+        that changes a value in place, such as an entry of
+        self['devices'], calls it itself.
+        """
+        # unpickling sets items before it restores the generation
+        self._generation = getattr(self, '_generation', 0) + 1
+
     def _defaults(self):
         defaults = {
             'name_label': 'Domain-Unnamed',
@@ -1048,6 +1075,20 @@ class XendConfig(dict):
         """
         self._dominfo_to_xapi(dominfo)
         self.validate()
+        self.changed()
+
+    def update_cpu_time(self, dominfo):
+        """Update only cpu_time with the output from xc.domain_getinfo().
+        Used by XendDomain when nothing else about the domain changed.
+
+        cpu_time changes on nearly every refresh, so it does not count as
+        a change of the configuration (see L{changed}); to_sxp_snapshot()
+        puts the current value in the snapshots it returns.
+
+        @param dominfo: Domain information via xc.domain_getinfo()
+        @type dominfo: dict
+        """
+        dict.__setitem__(self, 'cpu_time', dominfo['cpu_time']/1e9)
 
     def update_with_xenapi_config(self, xapi):
         """Update configuration with a Xen API VM struct
@@ -1090,6 +1131,7 @@ class XendConfig(dict):
             if key.startswith('cpumap'):
                 self['vcpus_params'][key] = \
                     ','.join(map(str, self._convert_cpus_to_list(val)))
+        self.changed()
 
     def cpuid_to_sxp(self, sxpr, field):
         regs_list = []
@@ -1144,13 +1186,6 @@ class XendConfig(dict):
                     sxpr.append([legacy, int(self[xenapi])])
                 else:
                     sxpr.append([legacy, self[xenapi]])
-#########################################################################
-#									#
-#		    	 domain group					#
-#									#
-#########################################################################	
-		else:
-		    log.debug("Unconverted key: " + xenapi)	
 
         MiB = 1024*1024
 
@@ -1234,8 +1269,54 @@ class XendConfig(dict):
 
         log.debug(sxpr)
 
-        return sxpr    
-    
+        return sxpr
+
+    def to_sxp_snapshot(self, domain, ignore_devices = False,
+                        legacy_only = True):
+        """ Get the SXP representation of to_sxp(), reusing the one last
+        built for the same arguments while the configuration and the
+        state of domain are unchanged.
+
+        The devices of a running domain are read from the store, which
+        changes behind our back, so that representation is always
+        rebuilt.  The result is shared: callers must not modify it.
+
+        @keyword domain: XendDomainInfo this is the configuration of
+        @type    domain: XendDomainInfo
+        @rtype: list of list (SXP representation)
+        """
+        if not ignore_devices and domain.getDomid() is not None:
+            return self.to_sxp(domain = domain, legacy_only = legacy_only)
+
+        # taken before building, so that a change made meanwhile is seen
+        # by the next call
+        stamp = (getattr(self, '_generation', 0), domain.getDomid(),
+                 domain._stateGet(), domain.store_mfn, domain.console_mfn)
+        cpu_time = self.get('cpu_time')
+        key = (ignore_devices, legacy_only)
+        snapshots = self.__dict__.setdefault('_sxp_snapshots', {})
+        snapshot = snapshots.get(key)
+        if not snapshot or snapshot[0] != stamp:
+            sxpr = self.to_sxp(domain = domain,
+                               ignore_devices = ignore_devices,
+                               legacy_only = legacy_only)
+            snapshot = (stamp, sxpr, cpu_time)
+            snapshots[key] = snapshot
+        sxpr = snapshot[1]
+        if cpu_time in (None, []) or cpu_time == snapshot[2]:
+            return sxpr
+
+        # cpu_time is left out of the generation (see update_cpu_time), so
+        # the snapshot gets the current value in a copy
+        sxpr = list(sxpr)
+        for i, item in enumerate(sxpr):
+            if isinstance(item, list) and item[:1] == ['cpu_time']:
+                sxpr[i] = ['cpu_time', cpu_time]
+                break
+        else:
+            sxpr.append(['cpu_time', cpu_time])
+        return sxpr
+
     def _blkdev_name_to_number(self, dev):
         if 'ioemu:' in dev:
             _, dev = dev.split(':', 1)
@@ -1585,6 +1666,7 @@ class XendConfig(dict):
                     target['console_refs'].append(dev_uuid)
                     
             log.debug("XendConfig: reading device: %s" % scrub_password(dev_info))
+            self.changed()
             return dev_uuid
 
         if cfg_xenapi:
@@ -1693,6 +1775,7 @@ class XendConfig(dict):
                     raise XendConfigError('Creating vt100 consoles via '
                                           'Xen API is unsupported')
 
+            self.changed()
             return dev_uuid
 
         # no valid device to add
@@ -1735,6 +1818,7 @@ class XendConfig(dict):
                 dev_info['uuid'] = dev_uuid
                 self['devices'][dev_uuid] = (dev_type, dev_info)
                 self['vbd_refs'].append(dev_uuid)
+                self.changed()
                 return dev_uuid
 
         return ''
@@ -1912,6 +1996,7 @@ class XendConfig(dict):
             
             self['devices'][dev_uuid] = ('console', dev_info)
             self['console_refs'].append(dev_uuid)
+            self.changed()
             return dev_info
 
         return {}
@@ -1927,6 +2012,7 @@ class XendConfig(dict):
                         if k in dev_info and k not in value:
                             del dev_info[k]
                     dev_info.update(value)
+                self.changed()
                 break
 
     def console_get_all(self, protocol):
@@ -1984,6 +2070,7 @@ class XendConfig(dict):
                 self['devices'][dev_uuid] = (dev_type,
                                              {'devs': pci_devs,
                                               'uuid': dev_uuid})
+                self.changed()
                 return True
                 
             if dev_type == 'vscsi': # Special case for vscsi
@@ -2025,6 +2112,7 @@ class XendConfig(dict):
                 if vscsi_be is not None:
                     vscsi_info['backend'] = vscsi_be
                 self['devices'][dev_uuid] = (dev_type, vscsi_info)
+                self.changed()
                 return True
                 
             for opt_val in config[1:]:
@@ -2035,6 +2123,7 @@ class XendConfig(dict):
                     pass # no value for this config option
 
             self['devices'][dev_uuid] = (dev_type, dev_info)
+            self.changed()
             return True
         
         elif dev_uuid in self['devices'] and cfg_xenapi:
@@ -2042,6 +2131,7 @@ class XendConfig(dict):
             for key, val in cfg_xenapi.items():
                 dev_info[key] = val
             self['devices'][dev_uuid] = (dev_type, dev_info)
+            self.changed()
             return True
 
         return False
@@ -2214,6 +2304,7 @@ class XendConfig(dict):
             self['notes'] = self.notes_from_sxp(notes[0])
 
         self._hvm_boot_params_from_sxp(image_sxp)
+        self.changed()
 
     def set_notes(self, notes):
         'Add parsed elfnotes to image'
@@ -2280,6 +2371,7 @@ class XendConfig(dict):
                 opts = pci_opts_list_from_sxp(dev)
                 pci.append([domain, bus, slot, func, vdevfn, opts])
         self['platform']['pci'] = pci
+        self.changed()
  
     def handle_fileuris(self):
         for arg in [('PV_kernel', 'use_tmp_kernel'), 
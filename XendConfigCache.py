@@ -0,0 +1,152 @@
+#########################################################################
+#									#
+#			  Xend Config Cache				#
+#									#
+#########################################################################
+
+"""A cache of the parsed config.sxp of every managed domain, kept in
+CACHE_FILE in the managed domains directory.
+
+Each entry is a pickled XendConfig and a summary of it, keyed by the
+(path, mtime, size) of the config.sxp it was parsed from; an entry whose
+file changed is parsed again.  The summary is enough to list a dormant
+domain without unpickling its config.  Configs whose kernel or ramdisk
+came inline are never cached, as parsing them writes the temporary files
+they point at.
+"""
+
+import cPickle
+import os
+import shutil
+import tempfile
+
+from xen.xend.XendLogging import log
+
+CACHE_FILE = "config-cache.pickle"
+CACHE_VERSION = 3
+
+# config fields kept in the summary of an entry
+SUMMARY_FIELDS = ('uuid', 'name_label', 'on_xend_start', 'auto_power_on')
+# device classes whose Xen-API records (DPCI, DSCSI) are made by parsing
+XENAPI_DEVICE_CLASSES = ('pci', 'vscsi')
+
+
+def _summary(cfg):
+    summary = dict([(field, cfg.get(field)) for field in SUMMARY_FIELDS])
+    summary['xenapi_devices'] = bool([
+        dev_type for (dev_type, _) in cfg.get('devices', {}).values()
+        if dev_type in XENAPI_DEVICE_CLASSES])
+    return summary
+
+
+def _cacheable(cfg):
+    return not cfg.get('use_tmp_kernel') and not cfg.get('use_tmp_ramdisk')
+
+
+class ConfigCache:
+    """The cache of one managed domains directory, as read at startup.
+
+    @ivar hits: configs served from the cache
+    @ivar misses: configs parsed
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, CACHE_FILE)
+        self.entries = self._load()
+        self.used = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return {}
+        try:
+            f = open(self.path, 'rb')
+            try:
+                cache = cPickle.load(f)
+            finally:
+                f.close()
+            if cache.get('version') == CACHE_VERSION:
+                return cache['entries']
+            log.info("Discarding config cache %s of version %s", self.path,
+                     cache.get('version'))
+        except Exception, exn:
+            log.warn("Ignoring unreadable config cache %s: %s", self.path,
+                     exn)
+        return {}
+
+    def _entry(self, dom_uuid, cfg_file):
+        st = os.stat(cfg_file)
+        key = (cfg_file, st.st_mtime, st.st_size)
+        entry = self.entries.get(dom_uuid)
+        if entry and entry[0] == key:
+            return key, entry
+        return key, None
+
+    def _parse(self, dom_uuid, key, cfg_file, parse):
+        cfg = parse(cfg_file)
+        self.misses += 1
+        if _cacheable(cfg):
+            # pickled now, before the caller gets to change it; a config
+            # that cannot be pickled is loaded all the same, just not
+            # cached
+            try:
+                self.used[dom_uuid] = (key, cPickle.dumps(cfg, 2),
+                                       _summary(cfg))
+            except Exception:
+                log.exception("Not caching the config of %s", dom_uuid)
+        return cfg
+
+    def get(self, dom_uuid, cfg_file, parse):
+        """Return the config of a managed domain, parsing cfg_file with
+        parse(cfg_file) only if it changed since it was cached.
+
+        @rtype: XendConfig
+        """
+        key, entry = self._entry(dom_uuid, cfg_file)
+        if entry:
+            try:
+                cfg = cPickle.loads(entry[1])
+                self.used[dom_uuid] = entry
+                self.hits += 1
+                return cfg
+            except Exception:
+                log.exception("Bad config cache entry for %s", dom_uuid)
+        return self._parse(dom_uuid, key, cfg_file, parse)
+
+    def summary(self, dom_uuid, cfg_file, parse):
+        """Return the summary of the config of a managed domain, and the
+        config itself if it had to be parsed.
+
+        @return: (summary, XendConfig or None)
+        @rtype: tuple
+        """
+        key, entry = self._entry(dom_uuid, cfg_file)
+        if entry:
+            self.used[dom_uuid] = entry
+            self.hits += 1
+            return entry[2], None
+        cfg = self._parse(dom_uuid, key, cfg_file, parse)
+        return _summary(cfg), cfg
+
+    def save(self):
+        """Write back the entries used by this scan, so that those of
+        domains that are gone are dropped."""
+        if self.used == self.entries:
+            return
+        fn = None
+        try:
+            fd, fn = tempfile.mkstemp(dir = self.directory)
+            f = os.fdopen(fd, 'wb')
+            try:
+                cPickle.dump({'version': CACHE_VERSION,
+                              'entries': self.used}, f, 2)
+            finally:
+                f.close()
+            shutil.move(fn, self.path)
+        except Exception:
+            # the cache is only an optimisation
+            log.exception("Failed to write config cache %s", self.path)
+            if fn and os.path.exists(fn):
+                os.remove(fn)
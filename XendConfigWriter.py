@@ -0,0 +1,147 @@
+#########################################################################
+#									#
+#			  Xend Config Writer				#
+#									#
+#########################################################################
+
+"""Write-behind saving of managed domain configs.
+
+A save only queues the domain.  Saves of the same domain within the
+delay are coalesced, and a background thread writes the last state.
+flush() is the barrier for anything that needs the configs on disk:
+shutdown, migration, removal.
+"""
+
+import threading
+import time
+
+from xen.xend import XendOptions
+from xen.xend.XendError import XendError
+from xen.xend.XendLogging import log
+
+# ms a save waits for more changes to the same domain
+DEFAULT_DELAY = 100
+
+xoptions = XendOptions.instance()
+
+
+class ConfigWriter:
+    """Queues domains by uuid and calls write(dominfo) for each, at most
+    once per delay.
+
+    @ivar delay: seconds a queued save waits
+    @ivar saves: saves requested
+    @ivar writes: configs written
+    """
+
+    def __init__(self, write, delay = None):
+        if delay is None:
+            delay = xoptions.get_config_int('xend-config-save-delay',
+                                            DEFAULT_DELAY) / 1000.0
+        self.write = write
+        self.delay = max(0, delay)
+        self.pending = {}
+        self.writing = {}
+        self.errors = {}
+        self.saves = 0
+        self.writes = 0
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def save(self, dom_uuid, dominfo):
+        """Queue a write of the config of dominfo."""
+        self.cond.acquire()
+        try:
+            self.saves += 1
+            if dom_uuid in self.pending:
+                self.pending[dom_uuid] = (self.pending[dom_uuid][0], dominfo)
+            else:
+                self.pending[dom_uuid] = (time.time() + self.delay, dominfo)
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def discard(self, dom_uuid):
+        """Drop a queued write, waiting out one in progress, so that the
+        config can be removed."""
+        self.cond.acquire()
+        try:
+            self.pending.pop(dom_uuid, None)
+            self.errors.pop(dom_uuid, None)
+            while dom_uuid in self.writing:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def flush(self, dom_uuid = None):
+        """Write the queued configs now, of one domain or of all of them,
+        and wait until they are on disk.
+
+        @raise XendError: a config could not be written
+        """
+        self.cond.acquire()
+        try:
+            if dom_uuid is None:
+                uuids = self.pending.keys() + self.writing.keys()
+            else:
+                uuids = [dom_uuid]
+            for u in uuids:
+                if u in self.pending:
+                    self.pending[u] = (0, self.pending[u][1])
+            self.cond.notifyAll()
+            while [u for u in uuids if u in self.pending or u in self.writing]:
+                self.cond.wait()
+            failed = [(u, self.errors.pop(u)) for u in uuids
+                      if u in self.errors]
+        finally:
+            self.cond.release()
+        if failed:
+            raise XendError("Failed to save configuration of %s" %
+                            ", ".join(["%s (%s)" % f for f in failed]))
+
+    def _due(self):
+        now = time.time()
+        due = [u for u, (at, _) in self.pending.items() if at <= now]
+        if due:
+            return due, None
+        if self.pending:
+            return [], min([at for at, _ in self.pending.values()]) - now
+        return [], None
+
+    def _run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                due, wait = self._due()
+                while not due:
+                    self.cond.wait(wait)
+                    due, wait = self._due()
+                batch = []
+                for u in due:
+                    _, dominfo = self.pending.pop(u)
+                    self.writing[u] = True
+                    batch.append((u, dominfo))
+            finally:
+                self.cond.release()
+
+            for u, dominfo in batch:
+                try:
+                    self.write(dominfo)
+                    self.writes += 1
+                    error = None
+                except Exception, exn:
+                    log.exception("Error saving configuration of %s", u)
+                    error = exn
+
+                self.cond.acquire()
+                try:
+                    del self.writing[u]
+                    if error is None:
+                        self.errors.pop(u, None)
+                    else:
+                        self.errors[u] = error
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
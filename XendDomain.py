@@ -14,14 +14,19 @@ import shutil
 import socket
 import tempfile
 import threading
+import time
 import re
 
 import xen.lowlevel.xc
 
 
 from xen.xend import XendOptions, XendCheckpoint, XendDomainInfo
-from xen.xend.PrettyPrint import prettyprint
+from xen.xend import XendSaveCatalog
+from xen.xend import XendRelocationStream
 from xen.xend import XendConfig, image
+from xen.xend import XendConfigCache
+from xen.xend import XendConfigWriter
+from xen.xend import XendSxp
 from xen.xend.XendError import XendError, XendInvalidDomain, VmError
 from xen.xend.XendError import VMBadState
 from xen.xend.XendLogging import log
@@ -33,6 +38,7 @@ from xen.xend.XendConstants import DOM_STATE_SHUTDOWN, DOM_STATE_UNKNOWN
 from xen.xend.XendConstants import DOM_STATE_CRASHED, HVM_PARAM_ACPI_S_STATE
 from xen.xend.XendConstants import TRIGGER_TYPE, TRIGGER_S3RESUME
 from xen.xend.XendDevices import XendDevices
+from xen.xend.XendVMMetrics import XendVMMetrics
 from xen.xend.XendAPIConstants import *
 
 from xen.xend.xenstore.xstransact import xstransact
@@ -61,6 +67,80 @@ POWER_STATE_NAMES = dict([(x, XEN_API_VM_POWER_STATE[x])
                                     DOM_STATE_UNKNOWN]])
 POWER_STATE_ALL = 'all'
 
+# Fields of an xc.domain_getinfo() record that need a full
+# XendDomainInfo.update when they change.  cpu_time is tracked on its own
+# as it changes on nearly every refresh and needs no further processing.
+REFRESH_FIELDS = ('dgid', 'dying', 'crashed', 'shutdown', 'shutdown_reason',
+                  'paused', 'blocked', 'running', 'mem_kb', 'maxmem_kb',
+                  'online_vcpus', 'max_vcpu_id')
+
+
+class DormantDomain(object):
+    """Stands in for a managed domain that is not running, from a summary
+    of its config (see XendConfigCache).
+
+    Its name, uuid and power state come from the summary.  Anything else
+    builds the XendDomainInfo from the config file, puts it in place of
+    this proxy in XendDomain, and is passed on to it from then on.
+
+    Its VM_metrics record is registered with the proxy, so that Xen-API
+    lists it without building the domain, and is kept by the
+    XendDomainInfo once built.
+
+    @ivar summary: config fields known without parsing the config
+    @ivar cfg_file: path of the domain's config.sxp
+    @ivar metrics: the VM_metrics record of the domain
+    """
+
+    def __init__(self, summary, cfg_file):
+        object.__setattr__(self, 'summary', summary)
+        object.__setattr__(self, 'cfg_file', cfg_file)
+        object.__setattr__(self, '_dominfo', None)
+        object.__setattr__(self, 'metrics',
+                           XendVMMetrics(uuid.createString(), self))
+
+    def materialise(self):
+        """@return: the XendDomainInfo of this domain
+        @rtype: XendDomainInfo
+        """
+        if self._dominfo is None:
+            instance()._managed_domain_build(self)
+        return self._dominfo
+
+    def get_uuid(self):
+        if self._dominfo:
+            return self._dominfo.get_uuid()
+        return self.summary['uuid']
+
+    def getName(self):
+        if self._dominfo:
+            return self._dominfo.getName()
+        return self.summary['name_label']
+
+    def getDomid(self):
+        if self._dominfo:
+            return self._dominfo.getDomid()
+        return None
+
+    def _stateGet(self):
+        if self._dominfo:
+            return self._dominfo._stateGet()
+        if os.path.exists(instance()._managed_check_point_path(
+            self.summary['uuid'])):
+            return DOM_STATE_SUSPENDED
+        return DOM_STATE_HALTED
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(self.materialise(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.materialise(), name, value)
+
+    def __str__(self):
+        return '<DormantDomain %s %s>' % (self.getName(), self.get_uuid())
+
 
 class XendDomain:
     """Index of all domains. Singleton.
@@ -68,7 +148,14 @@ class XendDomain:
     @ivar domains: map of domains indexed by domid
     @type domains: dict of XendDomainInfo
     @ivar managed_domains: domains that are not running and managed by Xend
-    @type managed_domains: dict of XendDomainInfo indexed by uuid
+    @type managed_domains: dict of XendDomainInfo or DormantDomain indexed
+                           by uuid
+    @ivar domains_by_name: running domains indexed by name
+    @type domains_by_name: dict of XendDomainInfo
+    @ivar domains_by_uuid: running domains indexed by uuid
+    @type domains_by_uuid: dict of XendDomainInfo
+    @ivar managed_domains_by_name: managed domains indexed by name
+    @type managed_domains_by_name: dict of XendDomainInfo
     @ivar domains_lock: lock that must be held when manipulating self.domains
     @type domains_lock: threaading.RLock
     @ivar _allow_new_domains: Flag to set that allows creating of new domains.
@@ -80,8 +167,41 @@ class XendDomain:
         self.managed_domains = {}
         self.domains_lock = threading.RLock()
 
+        # secondary indexes used by domain_lookup_nr, kept in step with
+        # self.domains and self.managed_domains.  The *_index_keys dicts
+        # remember, per id(dominfo), the keys a domain was indexed under
+        # so that renames can drop the stale entries.
+        self.domains_by_name = {}
+        self.domains_by_uuid = {}
+        self.managed_domains_by_name = {}
+        self._running_index_keys = {}
+        self._managed_index_keys = {}
+
+        # last xc.domain_getinfo() record applied to each running domain,
+        # used by _refreshTxn to skip domains that have not changed.
+        self._refresh_snapshot = {}
+        self.refresh_stats = {'refreshes': 0,
+                              'refreshes_shared': 0,
+                              'domains_updated': 0,
+                              'domains_skipped': 0}
+
+        # read-only lookups reuse a refresh that started less than
+        # refresh_window seconds ago (xend-refresh-window, in ms).
+        self.refresh_window = \
+            xoptions.get_config_int('xend-refresh-window', 250) / 1000.0
+        self._last_refresh = 0
+        # refreshes started, whether one is running, and the last one
+        # that completed; see _refresh_pending
+        self._refresh_seq = 0
+        self._refresh_running = False
+        self._refresh_done = 0
+
         self.policy_lock = rwlock.RWLock()
 
+        # managed configs are written behind managed_config_save
+        self.config_writer = \
+            XendConfigWriter.ConfigWriter(self._managed_config_write)
+
         # xen api instance vars
         # TODO: nothing uses this at the moment
         self._allow_new_domains = True
@@ -152,7 +272,8 @@ class XendDomain:
         self.domains_lock.acquire()
         try:
             running = self._running_domains()
-            managed = self._managed_domains()
+            cache = XendConfigCache.ConfigCache(self._managed_path())
+            managed = self._managed_domains(cache)
 
             # add all active domains
             for dom in running:
@@ -171,19 +292,28 @@ class XendDomain:
             image.cleanup_stale_sentinel_fifos()
 
             # add all managed domains as dormant domains.
-            for dom in managed:
-                dom_uuid = dom.get('uuid')
-                if not dom_uuid:
-                    continue
-                
-                dom_name = dom.get('name_label', 'Domain-%s' % dom_uuid)
+            for summary, cfg_file, dom in managed:
+                dom_uuid = summary['uuid']
+                dom_name = summary['name_label']
                 try:
                     running_dom = self.domain_lookup_nr(dom_name)
                     if not running_dom:
-                        # instantiate domain if not started.
-                        new_dom = XendDomainInfo.createDormant(dom)
+                        if dom is None:
+                            # built from its config when first needed
+                            new_dom = DormantDomain(summary, cfg_file)
+                        else:
+                            # parsed already, so nothing to save
+                            new_dom = XendDomainInfo.createDormant(dom)
                         self._managed_domain_register(new_dom)
+                        if dom is None and summary.get('xenapi_devices'):
+                            # its DPCI and DSCSI records depend on the
+                            # devices of this host, so they are made by
+                            # parsing the config rather than cached
+                            new_dom.materialise()
                     else:
+                        if dom is None:
+                            dom = cache.get(dom_uuid, cfg_file,
+                                            self._managed_config_parse)
                         self._managed_domain_register(running_dom)
                         for key in XendConfig.XENAPI_CFG_TYPES.keys():
                             if key not in XendConfig.LEGACY_XENSTORE_VM_PARAMS and \
@@ -204,6 +334,9 @@ class XendDomain:
                     log.exception("Failed to create reference to managed "
                                   "domain: %s" % dom_name)
 
+            cache.save()
+            log.debug("Managed domains: %d configs cached, %d parsed",
+                      cache.hits, cache.misses)
         finally:
             self.domains_lock.release()
 
@@ -255,6 +388,7 @@ class XendDomain:
         @raise XendError: fails to remove the domain.
         """
         config_path = self._managed_path(domuuid)
+        self.config_writer.discard(domuuid)
         try:
             if os.path.exists(config_path) and os.path.isdir(config_path):
                 shutil.rmtree(config_path)
@@ -264,11 +398,15 @@ class XendDomain:
                             " for domain: %s" % domuuid)            
 
     def managed_config_save(self, dominfo):
-        """Save a domain's configuration to disk
+        """Save a domain's configuration to disk.
+
+        The write is queued, and repeated saves of one domain within
+        xend-config-save-delay ms are written once, outside the caller's
+        locks.  Use L{managed_config_flush} to wait for it.
         
         @param domninfo: Managed domain to save.
         @type dominfo: XendDomainInfo
-        @raise XendError: fails to save configuration.
+        @raise XendError: fails to create the configuration directory.
         @rtype: None
         """
         if not self.is_domain_managed(dominfo):
@@ -289,67 +427,141 @@ class XendDomain:
             make_or_raise(domains_dir)
             make_or_raise(domain_config_dir)
 
-            try:
-                fd, fn = tempfile.mkstemp()
-                f = os.fdopen(fd, 'w+b')
-                try:
-                    prettyprint(dominfo.sxpr(legacy_only = False), f,
-                                width = 78)
-                finally:
-                    f.close()
-                    
-                try:
-                    shutil.move(fn, self._managed_config_path(dom_uuid))
-                except:
-                    log.exception("Renaming %s to %s", fn,
-                                  self._managed_config_path(dom_uuid))
-                    os.remove(fn)
-            except:
-                log.exception("Error occurred saving configuration file " +
-                              "to %s" % domain_config_dir)
-                raise XendError("Failed to save configuration file to: %s" %
-                                domain_config_dir)
+            self.config_writer.save(dom_uuid, dominfo)
         else:
             log.warn("Trying to save configuration for invalid domain")
 
+    def managed_config_flush(self, dominfo = None):
+        """Wait until the queued configuration of a domain, or of every
+        domain, is on disk.
+
+        @raise XendError: a configuration could not be saved
+        """
+        if dominfo:
+            self.config_writer.flush(dominfo.get_uuid())
+        else:
+            self.config_writer.flush()
+
+    def _managed_config_write(self, dominfo):
+        """Write a domain's configuration: to a temporary file in its
+        directory, synced, then renamed over config.sxp."""
+        if not self.is_domain_managed(dominfo):
+            return
+
+        dom_uuid = dominfo.get_uuid()
+        domain_config_dir = self._managed_path(dom_uuid)
+        try:
+            fd, fn = tempfile.mkstemp(dir = domain_config_dir)
+            f = os.fdopen(fd, 'w+b')
+            try:
+                f.write(XendSxp.pretty(dominfo.sxpr(legacy_only = False)))
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+                
+            try:
+                os.rename(fn, self._managed_config_path(dom_uuid))
+            except:
+                log.exception("Renaming %s to %s", fn,
+                              self._managed_config_path(dom_uuid))
+                os.remove(fn)
+                raise
+        except:
+            log.exception("Error occurred saving configuration file " +
+                          "to %s" % domain_config_dir)
+            raise XendError("Failed to save configuration file to: %s" %
+                            domain_config_dir)
+
+
+    def _managed_config_parse(self, cfg_file):
+        return XendConfig.XendConfig(filename = cfg_file)
 
-    def _managed_domains(self):
+    def _managed_domains(self, cache):
         """ Returns list of domains that are managed.
         
         Expects to be protected by domains_lock.
 
-        @rtype: list of XendConfig
-        @return: List of domain configurations that are managed.
+        @param cache: cache of the parsed configs
+        @type cache: XendConfigCache.ConfigCache
+        @rtype: list of tuple
+        @return: (summary, config path, XendConfig) of each managed domain;
+                 the XendConfig is None unless the config had to be parsed.
         """
         dom_path = self._managed_path()
         dom_uuids = os.listdir(dom_path)
         doms = []
         for dom_uuid in dom_uuids:
+            if not os.path.isdir(os.path.join(dom_path, dom_uuid)):
+                continue
             try:
                 cfg_file = self._managed_config_path(dom_uuid)
-                cfg = XendConfig.XendConfig(filename = cfg_file)
-                if cfg.get('uuid') != dom_uuid:
+                summary, cfg = cache.summary(dom_uuid, cfg_file,
+                                             self._managed_config_parse)
+                if summary.get('uuid') != dom_uuid:
                     # something is wrong with the SXP
                     log.error("UUID mismatch in stored configuration: %s" %
                               cfg_file)
                     continue
-                doms.append(cfg)
+                if not summary.get('name_label'):
+                    summary['name_label'] = 'Domain-%s' % dom_uuid
+                doms.append((summary, cfg_file, cfg))
             except Exception:
                 log.exception('Unable to open or parse config.sxp: %s' % \
                               cfg_file)
         return doms
 
+    def _managed_domain_build(self, proxy):
+        """Build the XendDomainInfo of a DormantDomain from its config and
+        register it in place of the proxy.
+        """
+        self.domains_lock.acquire()
+        try:
+            if proxy._dominfo is not None:
+                return
+            registered = self.managed_domains.get(proxy.get_uuid()) is proxy
+            # the proxy must not clash with the name check of its own domain
+            self._unindex_managed_domain(proxy)
+            try:
+                log.debug("Building dormant domain %s", proxy.getName())
+                dominfo = XendDomainInfo.createDormant(
+                    self._managed_config_parse(proxy.cfg_file))
+            except:
+                if registered:
+                    self._index_managed_domain(proxy)
+                raise
+            # Xen-API clients may hold the uuid of the proxy's record
+            dominfo.metrics.destroy()
+            dominfo.metrics = proxy.metrics
+            object.__setattr__(proxy, '_dominfo', dominfo)
+            if registered:
+                self._managed_domain_register(dominfo)
+        finally:
+            self.domains_lock.release()
+
     def _managed_domain_unregister(self, dom):
         try:
             if self.is_domain_managed(dom):
                 self._managed_config_remove(dom.get_uuid())
-                del self.managed_domains[dom.get_uuid()]
-                dom.destroy_xapi_instances()
+                old_dom = self.managed_domains.pop(dom.get_uuid())
+                self._unindex_managed_domain(old_dom)
+                # a dormant domain that was never built has no instances
+                # but its metrics
+                if not isinstance(dom, DormantDomain) or dom._dominfo:
+                    dom.destroy_xapi_instances()
+                else:
+                    dom.metrics.destroy()
         except ValueError:
             log.warn("Domain is not registered: %s" % dom.get_uuid())
 
     def _managed_domain_register(self, dom):
+        old_dom = self.managed_domains.get(dom.get_uuid())
+        if old_dom is not None and old_dom is not dom:
+            self._unindex_managed_domain(old_dom)
+            if isinstance(old_dom, DormantDomain) and not old_dom._dominfo:
+                old_dom.metrics.destroy()
         self.managed_domains[dom.get_uuid()] = dom
+        self._index_managed_domain(dom)
 
     def is_domain_managed(self, dom = None):
         return (dom.get_uuid() in self.managed_domains)
@@ -357,6 +569,75 @@ class XendDomain:
     # End of Managed Domain Access
     # --------------------------------------------------------------------
 
+    # --------------------------------------------------------------------
+    # Name and uuid indexes used by domain_lookup_nr
+
+    def _index_running_domain(self, dom):
+        """Index a running domain by its current name and uuid.
+
+        @requires: Expects to be protected by domains_lock.
+        """
+        self._unindex_running_domain(dom)
+        name = dom.getName()
+        dom_uuid = dom.get_uuid()
+        self.domains_by_name[name] = dom
+        self.domains_by_uuid[dom_uuid] = dom
+        self._running_index_keys[id(dom)] = (dom, name, dom_uuid)
+
+    def _unindex_running_domain(self, dom):
+        """Drop a running domain from the name and uuid indexes.
+
+        @requires: Expects to be protected by domains_lock.
+        """
+        keys = self._running_index_keys.pop(id(dom), None)
+        if keys:
+            _, name, dom_uuid = keys
+            if self.domains_by_name.get(name) is dom:
+                del self.domains_by_name[name]
+            if self.domains_by_uuid.get(dom_uuid) is dom:
+                del self.domains_by_uuid[dom_uuid]
+
+    def _index_managed_domain(self, dom):
+        """Index a managed domain by its current name.
+
+        @requires: Expects to be protected by domains_lock.
+        """
+        self._unindex_managed_domain(dom)
+        name = dom.getName()
+        self.managed_domains_by_name[name] = dom
+        self._managed_index_keys[id(dom)] = (dom, name)
+
+    def _unindex_managed_domain(self, dom):
+        """Drop a managed domain from the name index.
+
+        @requires: Expects to be protected by domains_lock.
+        """
+        keys = self._managed_index_keys.pop(id(dom), None)
+        if keys:
+            _, name = keys
+            if self.managed_domains_by_name.get(name) is dom:
+                del self.managed_domains_by_name[name]
+
+    def reindex_domain(self, dom):
+        """Update the index entries of a domain whose name or uuid has
+        changed.  Called by L{XendDomainInfo} whenever it renames itself;
+        domains that are not tracked here are ignored.
+
+        @param dom: renamed domain
+        @type dom: XendDomainInfo
+        """
+        self.domains_lock.acquire()
+        try:
+            if id(dom) in self._running_index_keys:
+                self._index_running_domain(dom)
+            if id(dom) in self._managed_index_keys:
+                self._index_managed_domain(dom)
+        finally:
+            self.domains_lock.release()
+
+    # End of name and uuid indexes
+    # --------------------------------------------------------------------
+
     def _running_domains(self):
         """Get table of domains indexed by id from xc.
 
@@ -398,23 +679,95 @@ class XendDomain:
         @rtype: None
         """
 
+        started = time.time()
+        self._refresh_seq += 1
+        seq = self._refresh_seq
+        self._refresh_running = True
         txn = xstransact()
         try:
-            self._refreshTxn(txn, refresh_shutdown)
-            txn.commit()
-        except:
-            txn.abort()
-            raise
+            try:
+                self._refreshTxn(txn, refresh_shutdown)
+                txn.commit()
+            except:
+                txn.abort()
+                raise
+        finally:
+            self._refresh_running = False
+        self._last_refresh = started
+        self._refresh_done = seq
+
+    def _refresh_pending(self):
+        """Note the refresh in progress, if any.  Called without the
+        domains_lock, before taking it, by the read-only calls that then
+        pass the result to L{_refresh_recent}.
+
+        @return: sequence number of the refresh running, or None
+        """
+        if self._refresh_running:
+            return self._refresh_seq
+        return None
+
+    def _refresh_recent(self, pending = None):
+        """Refresh the domain list for a read-only call, unless a
+        refresh it can share has been done: the one that was in progress
+        when the caller arrived (pending, from L{_refresh_pending}), or
+        one that started within the last refresh_window seconds.  Callers
+        queued on domains_lock behind a refresh, and pollers calling in
+        quick succession, so reuse it instead of running their own.
+        Mutating operations use L{_refresh}.
+
+        Expects to be protected by the domains_lock.
+
+        @rtype: None
+        """
+        if pending is not None and self._refresh_done >= pending:
+            self.refresh_stats['refreshes_shared'] += 1
+        elif time.time() - self._last_refresh >= self.refresh_window:
+            self._refresh(refresh_shutdown = False)
+        else:
+            self.refresh_stats['refreshes_shared'] += 1
 
     def _refreshTxn(self, transaction, refresh_shutdown):
         running = self._running_domains()
+        self.refresh_stats['refreshes'] += 1
+        groups_changed = False
+
         # Add domains that are not already tracked but running in Xen,
         # and update domain state for those that are running and tracked.
+        # Tracked domains whose record is unchanged since the last refresh
+        # are skipped, unless a shutdown is in progress: refreshShutdown
+        # then still has to run, to flag a guest ignoring the request as
+        # unresponsive or to act on a shutdown Xen reported.
         for dom in running:
             domid = dom['domid']
             if domid in self.domains:
-                self.domains[domid].update(dom, refresh_shutdown, transaction)
-            elif domid not in self.domains and dom['dying'] != 1:
+                dominfo = self.domains[domid]
+                key = [dom.get(f) for f in REFRESH_FIELDS]
+                last = self._refresh_snapshot.get(domid)
+                shutdown_pending = dominfo.shutdownStartTime or \
+                    (refresh_shutdown and (dom['shutdown'] or dom['crashed']))
+                if last and last['dominfo'] is dominfo and \
+                       last['key'] == key and not shutdown_pending and \
+                       (last['refresh_shutdown'] or not refresh_shutdown):
+                    if last['cpu_time'] != dom['cpu_time']:
+                        dominfo.info.update_cpu_time(dom)
+                        last['cpu_time'] = dom['cpu_time']
+                    self.refresh_stats['domains_skipped'] += 1
+                    continue
+
+                if not last or last['dgid'] != dom['dgid']:
+                    groups_changed = True
+                dominfo.update(dom, refresh_shutdown, transaction)
+                self._refresh_snapshot[domid] = {
+                    'dominfo': dominfo,
+                    'key': key,
+                    'dgid': dom['dgid'],
+                    'cpu_time': dom['cpu_time'],
+                    'refresh_shutdown': refresh_shutdown,
+                    }
+                self.refresh_stats['domains_updated'] += 1
+            elif dom['dying'] != 1:
+                groups_changed = True
                 try:
                     new_dom = XendDomainInfo.recreate(dom, False)
                 except VmError:
@@ -427,22 +780,36 @@ class XendDomain:
                         log.exception("Hard destruction of domain failed: %d" %
                                       domid)
 
-        # update information for all running domains
-        # - like cpu_time, status, dying, etc.
-        # remove domains that are not running from active domain list.
-        # The list might have changed by now, because the update call may
-        # cause new domains to be added, if the domain has rebooted.  We get
-        # the list again.
-        running = self._running_domains()
-        running_domids = [d['domid'] for d in running if d['dying'] != 1]
+        # Remove domains that are not running from active domain list.
+        # The snapshot taken above is reused: domains are only added while
+        # holding the domains_lock, and a domain restarted by the update
+        # calls above is created from a separate thread once we drop it.
+        running_domids = set([d['domid'] for d in running
+                              if d['dying'] != 1])
         for domid, dom in self.domains.items():
             if domid not in running_domids and domid != DOM0_ID:
                 self._remove_domain(dom, domid)
-#########################################################################									
-#		     update domain group information			#
+                groups_changed = True
 
-		xen.xend.XendDomainGroup.instance().refresh()	
 #########################################################################
+#		     update domain group information			#
+#########################################################################
+        if groups_changed:
+            xen.xend.XendDomainGroup.instance().refresh()
+
+    def get_refresh_stats(self):
+        """Counters of the incremental refresh in L{_refreshTxn}.
+
+        @rtype: dict
+        @return: number of refreshes, of read-only calls that shared a
+                 refresh instead of running one, and of per-domain updates
+                 done and skipped because the domain had not changed.
+        """
+        self.domains_lock.acquire()
+        try:
+            return dict(self.refresh_stats)
+        finally:
+            self.domains_lock.release()
 
     def add_domain(self, info):
         """Add a domain to the list of running domains
@@ -452,7 +819,11 @@ class XendDomain:
         @type info: XendDomainInfo
         """
         log.debug("Adding Domain: %s" % info.getDomid())
+        old_info = self.domains.get(info.getDomid())
+        if old_info is not None and old_info is not info:
+            self._unindex_running_domain(old_info)
         self.domains[info.getDomid()] = info
+        self._index_running_domain(info)
         
         # update the managed domains with a new XendDomainInfo object
         # if we are keeping track of it.
@@ -485,6 +856,10 @@ class XendDomain:
             
             if domid in self.domains:
                 del self.domains[domid]
+            last = self._refresh_snapshot.get(domid)
+            if last and last['dominfo'] is info:
+                del self._refresh_snapshot[domid]
+            self._unindex_running_domain(info)
 
             info.destroy_xapi_instances()
         else:
@@ -514,7 +889,7 @@ class XendDomain:
             self.domains_lock.release()
 
 
-    def domain_lookup(self, domid):
+    def domain_lookup(self, domid, force_refresh = False):
         """Look up given I{domid} in the list of managed and running
         domains.
         
@@ -524,13 +899,20 @@ class XendDomain:
 
         @param domid: Domain ID or Domain Name.
         @type domid: int or string
+        @keyword force_refresh: Refresh even if the domain list was
+                                refreshed within the refresh window.
+        @type force_refresh: bool
         @return: Found domain.
         @rtype: XendDomainInfo
         @raise XendInvalidDomain: If domain is not found.
         """
+        pending = self._refresh_pending()
         self.domains_lock.acquire()
         try:
-            self._refresh(refresh_shutdown = False)
+            if force_refresh:
+                self._refresh(refresh_shutdown = False)
+            else:
+                self._refresh_recent(pending)
             dom = self.domain_lookup_nr(domid)
             if not dom:
                 raise XendInvalidDomain(str(domid))
@@ -551,28 +933,25 @@ class XendDomain:
         self.domains_lock.acquire()
         try:
             # lookup by name
-            match = [dom for dom in self.domains.values() \
-                     if dom.getName() == domid]
-            if match:
-                return match[0]
+            dom = self.domains_by_name.get(domid)
+            if dom:
+                return dom
 
-            match = [dom for dom in self.managed_domains.values() \
-                     if dom.getName() == domid]
-            if match:
-                return match[0]
+            dom = self.managed_domains_by_name.get(domid)
+            if dom:
+                return dom
 
             # lookup by id
             try:
                 if int(domid) in self.domains:
                     return self.domains[int(domid)]
-            except ValueError:
+            except (ValueError, TypeError):
                 pass
 
             # lookup by uuid for running domains
-            match = [dom for dom in self.domains.values() \
-                     if dom.get_uuid() == domid]
-            if match:
-                return match[0]
+            dom = self.domains_by_uuid.get(domid)
+            if dom:
+                return dom
 
             # lookup by uuid for inactive managed domains 
             if domid in self.managed_domains:
@@ -582,6 +961,28 @@ class XendDomain:
         finally:
             self.domains_lock.release()
 
+    def domain_lookup_many(self, domids, force_refresh = False):
+        """Look up several domains after a single refresh.
+
+        @param domids: Domain IDs or Domain Names.
+        @type domids: list of int or string
+        @keyword force_refresh: as for L{domain_lookup}
+        @type force_refresh: bool
+        @return: Found domains, None for those not found, in the order
+                 of domids.
+        @rtype: list of XendDomainInfo or None
+        """
+        pending = self._refresh_pending()
+        self.domains_lock.acquire()
+        try:
+            if force_refresh:
+                self._refresh(refresh_shutdown = False)
+            else:
+                self._refresh_recent(pending)
+            return [self.domain_lookup_nr(domid) for domid in domids]
+        finally:
+            self.domains_lock.release()
+
     def privilegedDomain(self):
         """ Get the XendDomainInfo of a dom0
 
@@ -602,8 +1003,12 @@ class XendDomain:
         try:
             for dom_uuid, dom in self.managed_domains.items():
                 if dom and dom._stateGet() == DOM_STATE_HALTED:
-                    on_xend_start = dom.info.get('on_xend_start', 'ignore')
-                    auto_power_on = dom.info.get('auto_power_on', False)
+                    if isinstance(dom, DormantDomain):
+                        info = dom.summary
+                    else:
+                        info = dom.info
+                    on_xend_start = info.get('on_xend_start') or 'ignore'
+                    auto_power_on = info.get('auto_power_on') or False
                     should_start = (on_xend_start == 'start') or auto_power_on
                     if should_start:
                         need_starting.append(dom_uuid)
@@ -642,6 +1047,11 @@ class XendDomain:
         finally:
             self.domains_lock.release()
 
+        try:
+            self.managed_config_flush()
+        except XendError:
+            log.exception('Failed to save domain configurations')
+
 
 
     # ----------------------------------------------------------------
@@ -679,9 +1089,9 @@ class XendDomain:
     def get_vm_by_uuid(self, vm_uuid):
         self.domains_lock.acquire()
         try:
-            for dom in self.domains.values():
-                if dom.get_uuid() == vm_uuid:
-                    return dom
+            dom = self.domains_by_uuid.get(vm_uuid)
+            if dom:
+                return dom
 
             if vm_uuid in self.managed_domains:
                 return self.managed_domains[vm_uuid]
@@ -778,13 +1188,14 @@ class XendDomain:
                           (dominfo.getName(), dominfo.get_uuid()))
                 self._managed_domain_register(dominfo)
                 self.managed_config_save(dominfo)
-                return dominfo.get_uuid()
             except XendError, e:
                 raise
             except Exception, e:
                 raise XendError(str(e))
         finally:
             self.domains_lock.release()        
+        self.managed_config_flush(dominfo)
+        return dominfo.get_uuid()
 
     def rename_domain(self, dom, new_name):
         self.domains_lock.acquire()
@@ -815,9 +1226,10 @@ class XendDomain:
             state = POWER_STATE_NAMES[state]
         state = state.lower()
         
+        pending = self._refresh_pending()
         self.domains_lock.acquire()
         try:
-            self._refresh(refresh_shutdown = False)
+            self._refresh_recent(pending)
             
             # active domains
             active_domains = self.domains.values()
@@ -1025,6 +1437,8 @@ class XendDomain:
                 raise XendError(str(e))
         finally:
             self.domains_lock.release()
+        # a new domain fails here if its config cannot be saved
+        self.managed_config_flush(dominfo)
 
     def domain_start(self, domid, start_paused = True):
         """Start a managed domain
@@ -1144,6 +1558,28 @@ class XendDomain:
             raise XendError("can't read guest state file %s: %s" %
                             (src, ex[1]))
 
+    def domain_restore_striped(self, session):
+        """Restore a relocating domain from the connections of a
+        striped relocation.
+
+        @param session: as returned by XendRelocationStream.accept
+        @type session: XendRelocationStream.ReceiveSession
+        @rtype: XendDomainInfo
+        @raise XendError: if failed to restore
+        """
+        fd = session.open()
+        try:
+            dominfo = self.domain_restore_fd(fd, relocating=True)
+        except:
+            # the restore error is the one worth reporting
+            try:
+                session.close()
+            except XendError:
+                pass
+            raise
+        session.close()
+        return dominfo
+
     def domain_restore_fd(self, fd, paused=False, relocating=False):
         """Restore a domain from the given file descriptor.
 
@@ -1171,6 +1607,7 @@ class XendDomain:
                             self.managed_config_save(dominfo)
                         finally:
                             self.domains_lock.release()
+                        self.managed_config_flush(dominfo)
                 return dominfo
             except XendError, e:
                 log.exception("Restore failed")
@@ -1314,7 +1751,7 @@ class XendDomain:
         return val       
 
     def domain_migrate(self, domid, dst, live=False, port=0, node=-1, ssl=None,\
-                       chs=False):
+                       chs=False, compress=None):
         """Start domain migration.
         
         @param domid: Domain ID or Name
@@ -1331,6 +1768,9 @@ class XendDomain:
         @type ssl: bool
         @keyword chs: change home server for managed domain
         @type chs: bool
+        @keyword compress: stream compression, e.g. 'zlib:6' or 'lz4';
+                           None uses xend-checkpoint-compression
+        @type compress: string
         @rtype: None
         @raise XendError: Failed to migrate
         @raise XendInvalidDomain: Domain is not valid
@@ -1356,46 +1796,69 @@ class XendDomain:
             """ Make sure there's memory free for enabling shadow mode """
             dominfo.checkLiveMigrateMemory()
 
+        # the config on disk must be current before the domain leaves
+        self.managed_config_flush(dominfo)
+
         if ssl is None:
             ssl = xoptions.get_xend_relocation_ssl()
 
         try:
             dominfo.setChangeHomeServer(chs)
             if ssl:
-                self._domain_migrate_by_ssl(dominfo, dst, live, port, node)
+                self._domain_migrate_by_ssl(dominfo, dst, live, port, node,
+                                            compress)
             else:
-                self._domain_migrate(dominfo, dst, live, port, node)
+                self._domain_migrate(dominfo, dst, live, port, node,
+                                     compress)
         except:
             dominfo.setChangeHomeServer(None)
             raise
 
-    def _domain_migrate_by_ssl(self, dominfo, dst, live, port, node):
+    def _domain_migrate_by_ssl(self, dominfo, dst, live, port, node,
+                               compress=None):
         from OpenSSL import SSL
         from xen.web import connection
         if port == 0:
             port = xoptions.get_xend_relocation_ssl_port()
-        try:
+
+        def open_connection():
             ctx = SSL.Context(SSL.SSLv23_METHOD)
             sock = SSL.Connection(ctx,
                        socket.socket(socket.AF_INET, socket.SOCK_STREAM))
             sock.set_connect_state()
             sock.connect((dst, port))
-            sock.send("sslreceive\n")
-            sock.recv(80)
+            return sock
+
+        try:
+            socks = XendRelocationStream.connect(open_connection,
+                                                 "sslreceive")
         except SSL.Error, err:
             raise XendError("SSL error: %s" % err)
         except socket.error, err:
             raise XendError("can't connect: %s" % err)
-
-        p2cread, p2cwrite = os.pipe()
-        threading.Thread(target=connection.SSLSocketServerConnection.fd2send,
-                         args=(sock, p2cread)).start()
+        sock = socks[0]
+
+        # Several connections are striped with a session on each, so the
+        # encryption is spread over as many threads.
+        if len(socks) > 1:
+            sender = XendRelocationStream.StripeSender(socks)
+            p2cread = None
+            p2cwrite = sender.fd
+        else:
+            sender = None
+            p2cread, p2cwrite = os.pipe()
+            threading.Thread(
+                target=connection.SSLSocketServerConnection.fd2send,
+                args=(sock, p2cread)).start()
 
         try:
             try:
                 XendCheckpoint.save(p2cwrite, dominfo, True, live, dst,
-                                    node=node)
+                                    node=node, compress=compress,
+                                    sender=sender)
             except Exception, ex:
+                if sender:
+                    self._relocation_abort(sender)
                 m_dsterr = None
                 try:
                     sock.settimeout(3.0)
@@ -1426,15 +1889,25 @@ class XendDomain:
                 # Ignore the exception because it has nothing to do with
                 # an exception of XendCheckpoint.save.
                 pass
-            sock.close()
+            for s in socks:
+                s.close()
+
+        if not sender:
+            os.close(p2cread)
+            os.close(p2cwrite)
 
-        os.close(p2cread)
-        os.close(p2cwrite)
+    def _relocation_abort(self, sender):
+        # The destination sees a short stream and reports its own error.
+        try:
+            sender.close()
+        except XendError:
+            pass
 
-    def _domain_migrate(self, dominfo, dst, live, port, node):
+    def _domain_migrate(self, dominfo, dst, live, port, node, compress=None):
         if port == 0:
             port = xoptions.get_xend_relocation_port()
-        try:
+
+        def open_connection():
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             # When connecting to our ssl enabled relocation server using a
             # plain socket, send will success but recv will block. Add a
@@ -1442,17 +1915,31 @@ class XendDomain:
             # inform the client.
             sock.settimeout(30.0)
             sock.connect((dst, port))
-            sock.send("receive\n")
-            sock.recv(80)
-            sock.settimeout(None)
+            return sock
+
+        try:
+            socks = XendRelocationStream.connect(open_connection, "receive")
+            for s in socks:
+                s.settimeout(None)
         except socket.error, err:
             raise XendError("can't connect: %s" % err)
+        sock = socks[0]
+
+        if len(socks) > 1:
+            sender = XendRelocationStream.StripeSender(socks)
+            fd = sender.fd
+        else:
+            sender = None
+            fd = sock.fileno()
 
         try:
             try:
-                XendCheckpoint.save(sock.fileno(), dominfo, True, live,
-                                    dst, node=node)
+                XendCheckpoint.save(fd, dominfo, True, live,
+                                    dst, node=node, compress=compress,
+                                    sender=sender)
             except Exception, ex:
+                if sender:
+                    self._relocation_abort(sender)
                 m_dsterr = None
                 try:
                     sock.settimeout(3.0)
@@ -1483,15 +1970,23 @@ class XendDomain:
                 # Ignore the exception because it has nothing to do with
                 # an exception of XendCheckpoint.save.
                 pass
-            sock.close()
+            for s in socks:
+                s.close()
 
-    def domain_save(self, domid, dst, checkpoint=False):
+    def domain_save(self, domid, dst, checkpoint=False, group_paused=False,
+                    compress=None):
         """Start saving a domain to file.
 
         @param domid: Domain ID or Name
         @type domid: int or string.
         @param dst: Destination filename
         @type dst: string
+        @keyword group_paused: The domain was paused together with its
+                               group for a group checkpoint.
+        @type group_paused: bool
+        @keyword compress: image compression, e.g. 'zlib:6' or 'lz4';
+                           None uses xend-checkpoint-compression
+        @type compress: string
         @rtype: None
         @raise XendError: Failed to save domain
         @raise XendInvalidDomain: Domain is not valid        
@@ -1503,22 +1998,35 @@ class XendDomain:
 
             if dominfo.getDomid() == DOM0_ID:
                 raise XendError("Cannot save privileged domain %s" % str(domid))
-            if dominfo._stateGet() != DOM_STATE_RUNNING:
+            if group_paused:
+                allowed_states = (DOM_STATE_RUNNING, DOM_STATE_PAUSED)
+            else:
+                allowed_states = (DOM_STATE_RUNNING,)
+            if dominfo._stateGet() not in allowed_states:
                 raise VMBadState("Domain is not running",
                                  POWER_STATE_NAMES[DOM_STATE_RUNNING],
                                  POWER_STATE_NAMES[dominfo._stateGet()])
 
+            self.managed_config_flush(dominfo)
+
             oflags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
             if hasattr(os, "O_LARGEFILE"):
                 oflags |= os.O_LARGEFILE
             fd = os.open(dst, oflags)
             try:
                 XendCheckpoint.save(fd, dominfo, False, False, dst,
-                                    checkpoint=checkpoint)
+                                    checkpoint=checkpoint,
+                                    group_paused=group_paused,
+                                    compress=compress)
             except Exception, e:
                 os.close(fd)
                 raise e
             os.close(fd)
+
+            try:
+                XendSaveCatalog.record(dst)
+            except:
+                log.exception("Unable to catalog save image %s", dst)
         except OSError, ex:
             raise XendError("can't write guest state file %s: %s" %
                             (dst, ex[1]))
@@ -1652,7 +2160,7 @@ class XendDomain:
         @type op: int
         @rtype: 0
         """
-        dominfo = self.domain_lookup(domid)
+        dominfo = self.domain_lookup(domid, force_refresh = True)
         try:
             return xc.shadow_control(dominfo.getDomid(), op)
         except Exception, ex:
@@ -1682,7 +2190,7 @@ class XendDomain:
         @rtype: int
         @return: shadow memory in MB
         """
-        dominfo = self.domain_lookup(domid)
+        dominfo = self.domain_lookup(domid, force_refresh = True)
         try:
             return xc.shadow_mem_control(dominfo.getDomid(), mb=mb)
         except Exception, ex:
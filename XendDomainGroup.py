@@ -8,29 +8,62 @@
 
 import logging
 import os
+import shutil
 import socket
+import stat
 import sys
+import tempfile
 import threading
+import time
 import uuid
 
 import xen.lowlevel.xc
 from xen.xend import XendDomain
 from xen.xend import XendDomainGroupInfo
-from xen.xend.XendError import XendError
+from xen.xend import XendCheckpoint, XendSaveCatalog, balloon
+from xen.xend.XendDomainGroupExecutor import XendDomainGroupExecutor, \
+     member_result
+from xen.xend.XendError import XendError, XendInvalidDomainGroup
+from xen.xend.xenstore.xstransact import complete
 from XendLogging import log
 from xen.xend.XendConstants import XS_GRPROOT, GROUP0_ID, \
      GROUP0_NAME, NULL_GROUP_ID, NULL_GROUP_NAME
+from xen.xend import XendOptions
+from xen.xend import sxp
+from xen.xend.PrettyPrint import prettyprint
+from xen.util import mkdir
 
 
 xc = xen.lowlevel.xc.xc()
+xoptions = XendOptions.instance()
+
+DEFAULT_MIGRATE_STREAMS = 4
+
+# grp_suspend keeps its member images here, one directory per dguuid
+GROUP_SAVE_DIR = "/var/lib/xen/group-save"
+GROUP_MANIFEST = "manifest.sxp"
 
 
 class XendDomainGroup:
 
     def __init__(self):
         self.domain_groups = {}
+        self.domain_groups_by_name = {}
+        self.domain_groups_by_uuid = {}
         self.domain_groups_lock = threading.RLock()
         self.xd = XendDomain.instance()
+        self._last_refresh = 0
+        # refreshes started and running, and the last one completed; a
+        # refresh may run from XendDomain without domain_groups_lock
+        self._refresh_lock = threading.Lock()
+        self._refresh_seq = 0
+        self._refresh_running = 0
+        self._refresh_done = 0
+        self.store_stats = {'written': 0, 'skipped': 0, 'transactions': 0}
+        # member states of the last grp_migrate of each group, by dgid
+        self.grp_migrations = {}
+        # (handle, member names, config) per dgid from xen_domain_groups
+        self._grp_configs = {}
         self.xst = xen.xend.xenstore.xstransact.xstransact
 
 ##########################################################
@@ -66,7 +99,12 @@ class XendDomainGroup:
 ##########################################################
     def _add_domain_group(self, info):
         dgid = info.dgid
+        old = self.domain_groups.get(dgid)
+        if old and old is not info:
+            self._unindex_domain_group(old, old.getName(), old.getDguuid())
         self.domain_groups[dgid] = info
+        self.domain_groups_by_name[info.getName()] = info
+        self.domain_groups_by_uuid[info.getDguuid()] = info
         log.debug("Added grp%s to domain_groups: %s", dgid, info)
 
 
@@ -77,9 +115,35 @@ class XendDomainGroup:
         info = self.domain_groups.get(dgid)
         if info:
             del self.domain_groups[dgid]
+            self._unindex_domain_group(info, info.getName(), info.getDguuid())
         log.debug("Deleted grp%s from domain_groups", dgid)
 
 
+##########################################################
+#		group name/dguuid indexes		 #
+##########################################################
+    def _unindex_domain_group(self, info, name, dguuid):
+        if self.domain_groups_by_name.get(name) is info:
+            del self.domain_groups_by_name[name]
+        if self.domain_groups_by_uuid.get(dguuid) is info:
+            del self.domain_groups_by_uuid[dguuid]
+
+    def _reindex_domain_group(self, info, old_name, old_dguuid):
+        """Called by XendDomainGroupInfo.update when a group's name or
+        dguuid may have changed.  Groups that are not (yet) registered in
+        domain_groups are ignored.
+        """
+        self.domain_groups_lock.acquire()
+        try:
+            if self.domain_groups.get(info.dgid) is not info:
+                return
+            self._unindex_domain_group(info, old_name, old_dguuid)
+            self.domain_groups_by_name[info.getName()] = info
+            self.domain_groups_by_uuid[info.getDguuid()] = info
+        finally:
+            self.domain_groups_lock.release()
+
+
 ##########################################################
 #		pre-pending group path			 #
 ##########################################################
@@ -111,7 +175,7 @@ class XendDomainGroup:
 ##########################################################
 #		rebuild group config data		 #
 ##########################################################
-    def _rebuild_config(self, grpdata):
+    def _member_names(self, grpdata):
         domlist = []
         for domid in grpdata['member_list']:
             dominfo = self.xd.domain_lookup_nr(domid)
@@ -121,6 +185,11 @@ class XendDomainGroup:
                 # but at the moment there is no need for accurate values once
                 # the members are started
                 domlist.append(domname+":nullconfig")
+        return domlist
+
+    def _rebuild_config(self, grpdata, domlist = None):
+        if domlist is None:
+            domlist = self._member_names(grpdata)
 
         sxpr = {}
         sxpr['dgid'] = grpdata['dgid']
@@ -137,12 +206,31 @@ class XendDomainGroup:
 #		xen domain group			 #
 ##########################################################
     def xen_domain_groups(self):
+        """Return the config of every group Xen knows about, by dgid.
+
+        Only groups whose handle or membership changed since the last
+        call are rebuilt; the others reuse their previous config and so
+        skip the xenstore read of their name.
+        """
         grps = {}
+        configs = {}
         grplist = xc.domain_group_getinfo()
         for grp in grplist:
             dgid = grp['dgid']
-            grpdata = self._rebuild_config(grp)
-            grps[dgid] = grpdata
+            handle = tuple(grp['dg_handle'])
+            domlist = self._member_names(grp)
+            cached = self._grp_configs.get(dgid)
+            if cached and cached[0] == handle and cached[1] == domlist:
+                grpdata = cached[2]
+            else:
+                grpdata = self._rebuild_config(grp, domlist)
+            # a fallback name is not kept: the group may not have been
+            # written to xenstore yet
+            if grpdata['grp_name'] != "Group-%s" % grpdata['dguuid']:
+                configs[dgid] = (handle, domlist, grpdata)
+            # callers modify the dict they are given
+            grps[dgid] = dict(grpdata)
+        self._grp_configs = configs
         return grps
 
 
@@ -150,6 +238,28 @@ class XendDomainGroup:
 #		refresh	group				 #
 ##########################################################
     def refresh(self):
+        started = time.time()
+        self._refresh_lock.acquire()
+        try:
+            self._refresh_seq += 1
+            seq = self._refresh_seq
+            self._refresh_running += 1
+        finally:
+            self._refresh_lock.release()
+        completed = False
+        try:
+            self._refresh(started)
+            completed = True
+        finally:
+            self._refresh_lock.acquire()
+            try:
+                self._refresh_running -= 1
+                if completed:
+                    self._refresh_done = max(self._refresh_done, seq)
+            finally:
+                self._refresh_lock.release()
+
+    def _refresh(self, started):
         grps = self.xen_domain_groups()
 
         for grp in self.domain_groups.values():
@@ -169,14 +279,66 @@ class XendDomainGroup:
                         "Failed to recreate information for domain "
                         "group %d.", grp)
 
-       self.push_grp_data_to_xenstore()
+        self.push_grp_data_to_xenstore()
+        self._last_refresh = started
+
+##########################################################
+#		refresh group if stale			 #
+##########################################################
+    def _refresh_pending(self):
+        """@return: sequence number of the latest refresh if one is
+        running, else None; taken before domain_groups_lock and passed to
+        _refresh_recent"""
+        if self._refresh_running:
+            return self._refresh_seq
+        return None
+
+    def _refresh_recent(self, pending = None):
+        """Refresh unless the refresh running when the caller arrived
+        (pending) has completed since, or one started within the domain
+        refresh window (see XendDomain._refresh_recent).  Only for
+        read-only callers; expects to be protected by the
+        domain_groups_lock.
+        """
+        if pending is not None and self._refresh_done >= pending:
+            return
+        if time.time() - self._last_refresh >= self.xd.refresh_window:
+            self.refresh()
 
 ##########################################################
 #		push group data to xenstore		 #
 ##########################################################
     def push_grp_data_to_xenstore(self):
-        for grpinfo in self.domain_groups.values():
-            grpinfo.storeGrpDetails()
+        """Write the details of every group that changed since it was
+        last stored, all in a single xenstore transaction.
+        """
+        grps = self.domain_groups.values()
+        dirty = [grpinfo for grpinfo in grps if grpinfo.grpDetailsDirty()]
+        self.store_stats['skipped'] += len(grps) - len(dirty)
+        if not dirty:
+            return
+
+        def store(t):
+            for grpinfo in dirty:
+                grpinfo.storeGrpDetails(t)
+
+        try:
+            complete("", store)
+        except:
+            for grpinfo in dirty:
+                grpinfo.invalidateGrpDetails()
+            raise
+        self.store_stats['written'] += len(dirty)
+        self.store_stats['transactions'] += 1
+
+    def get_store_stats(self):
+        """Counters of push_grp_data_to_xenstore: groups written, groups
+        skipped because they were unchanged, and transactions used."""
+        self.domain_groups_lock.acquire()
+        try:
+            return dict(self.store_stats)
+        finally:
+            self.domain_groups_lock.release()
 
 
 ##########################################################
@@ -186,21 +348,17 @@ class XendDomainGroup:
         self.domain_groups_lock.acquire()
         try:
             # match by name
-            for grpinfo in self.domain_groups.values():
-                if grpinfo.getName() == grp:
-                    return grpinfo
+            grpinfo = self.domain_groups_by_name.get(grp)
+            if grpinfo:
+                return grpinfo
             # match by id
             try:
                 if int(grp) in self.domain_groups:
                     return self.domain_groups[int(grp)]
-            except ValueError:
+            except (ValueError, TypeError):
                 pass
             # match by dguuid
-            for grpinfo in self.domain_groups.values():
-                if grpinfo.getDguuid() == grp:
-                    return grpinfo
-            # group not found
-            return None
+            return self.domain_groups_by_uuid.get(grp)
         finally:
             self.domain_groups_lock.release()
 
@@ -208,10 +366,14 @@ class XendDomainGroup:
 ##########################################################
 #		group lookup				 #
 ##########################################################
-    def grp_lookup(self, grp):
+    def grp_lookup(self, grp, force_refresh = False):
+        pending = self._refresh_pending()
         self.domain_groups_lock.acquire()
         try:
-            self.refresh()
+            if force_refresh:
+                self.refresh()
+            else:
+                self._refresh_recent(pending)
             return self.grp_lookup_nr(grp)
         finally:
             self.domain_groups_lock.release()
@@ -221,16 +383,73 @@ class XendDomainGroup:
 #		group members info			 #
 ##########################################################
     def grp_members(self, dgid):
-        grpinfo = self.grp_lookup(dgid)
-       return grpinfo.members
+        grpinfo = self.grp_lookup(dgid, force_refresh = True)
+        if not grpinfo:
+            raise XendInvalidDomainGroup(str(dgid))
+        return grpinfo.members
+
+##########################################################
+#		resolve group member domains		 #
+##########################################################
+    def _grp_member_domains(self, dgid):
+        """Return (name, XendDomainInfo or None) for every member of a
+        group, with one group refresh and one domain refresh in total.
+        """
+        members = self.grp_members(dgid)
+        doms = self.xd.domain_lookup_many(members, force_refresh = True)
+        return zip(members, doms)
+
+##########################################################
+#		run an operation on every member	 #
+##########################################################
+    def _grp_member_op(self, dgid, op):
+        """Run op(dominfo) on every member of a group in parallel.
+
+        @return: per-member results, see XendDomainGroupExecutor
+        @rtype: list of dict
+        """
+        def member_op(member):
+            domname, dominfo = member
+            if not dominfo:
+                raise XendError("Group member %s not found" % domname)
+            op(dominfo)
+
+        return XendDomainGroupExecutor().run(self._grp_member_domains(dgid),
+                                             member_op,
+                                             name = lambda m: m[0])
+
+##########################################################
+#		run a group-wide hypercall		 #
+##########################################################
+    def _grp_hypercall(self, dgid, op):
+        """Run op(grpinfo) once for the whole group and report its
+        outcome for every member, in the same form as _grp_member_op.
+        """
+        self.domain_groups_lock.acquire()
+        try:
+            grpinfo = self.grp_lookup(dgid, force_refresh = True)
+            if not grpinfo:
+                raise XendInvalidDomainGroup(str(dgid))
+            started = time.time()
+            try:
+                op(grpinfo)
+                ok, error = True, ''
+            except Exception, exn:
+                log.exception("Group operation failed on grp%s", dgid)
+                ok, error = False, str(exn)
+            return [member_result(domname, ok, error, started)
+                    for domname in grpinfo.members]
+        finally:
+            self.domain_groups_lock.release()
 
 ##########################################################
 #		group list				 #
 ##########################################################
     def grp_list(self):
+        pending = self._refresh_pending()
         self.domain_groups_lock.acquire()
         try:
-            self.refresh()
+            self._refresh_recent(pending)
             return self.domain_groups.values()
         finally:
             self.domain_groups_lock.release()
@@ -251,10 +470,8 @@ class XendDomainGroup:
 #		group shutdown				 #
 ##########################################################
     def grp_shutdown(self, dgid, reason):
-        members = self.grp_members(dgid)
-        for domname in members:
-            dominfo = self.xd.domain_lookup(domname)
-            dominfo.shutdown(reason)
+        return self._grp_member_op(dgid,
+                                   lambda dominfo: dominfo.shutdown(reason))
 
 ##########################################################
 #		group destroy				 #
@@ -263,7 +480,7 @@ class XendDomainGroup:
         ret = -1
         self.domain_groups_lock.acquire()
         try:
-            grpinfo = self.grp_lookup(dgid)
+            grpinfo = self.grp_lookup(dgid, force_refresh = True)
             ret = grpinfo.destroy(rmxs)
             if ret == 0:
                 self._delete_domain_group(dgid)
@@ -271,63 +488,281 @@ class XendDomainGroup:
             self.domain_groups_lock.release()
             return ret
 
+##########################################################
+#		gang checkpoint				 #
+##########################################################
+    def _grp_checkpoint(self, dgid, path_for, manifest_path, mode):
+        """Save every member of a group as of one point in time.
+
+        The group is paused with a single hypercall so that no member
+        runs ahead of the others, then all members are saved in parallel.
+        Each member only runs again for the short time it needs to act on
+        its suspend request.  When every member was saved a manifest
+        describing the group is written to manifest_path.
+
+        @param path_for: callable giving the image path of a member name
+        @param mode: 'save', 'suspend' or 'checkpoint'; in checkpoint mode
+                     the members keep running after the save
+        @return: (all members saved, per-member results)
+        @rtype: tuple
+        """
+        grpinfo = self.grp_lookup(dgid, force_refresh = True)
+        if not grpinfo:
+            raise XendInvalidDomainGroup(str(dgid))
+        members = self._grp_member_domains(grpinfo.dgid)
+        checkpoint = (mode == 'checkpoint')
+
+        def save(member):
+            domname, dominfo = member
+            if not dominfo:
+                raise XendError("Group member %s not found" % domname)
+            self.xd.domain_save(dominfo.getDomid(), path_for(domname),
+                                checkpoint = checkpoint,
+                                group_paused = True)
+
+        grpinfo.pause()
+        results = XendDomainGroupExecutor().run(members, save,
+                                                name = lambda m: m[0])
+        saved = [r['ok'] for r in results]
+        if checkpoint or False in saved:
+            # members that were resumed, or never got saved, go on running
+            try:
+                grpinfo.unpause()
+            except:
+                log.exception("Unable to unpause grp%s", grpinfo.dgid)
+
+        if False in saved:
+            log.error("Checkpoint of grp%s failed for: %s", grpinfo.dgid,
+                      ", ".join([r['member'] for r in results if not r['ok']]))
+            return False, results
+
+        self._write_grp_manifest(manifest_path, grpinfo, members, path_for,
+                                 mode)
+        return True, results
+
+    def _write_grp_manifest(self, path, grpinfo, members, path_for, mode):
+        manifest = ['group_checkpoint',
+                    ['dgid', grpinfo.dgid],
+                    ['dguuid', grpinfo.dguuid],
+                    ['grp_name', grpinfo.grp_name],
+                    ['mode', mode],
+                    ['created', int(time.time())]]
+        for domname, dominfo in members:
+            manifest.append(['member',
+                             ['name', domname],
+                             ['uuid', dominfo.get_uuid()],
+                             ['memory', dominfo.getMemoryTarget()],
+                             ['path', path_for(domname)]])
+
+        fd, fn = tempfile.mkstemp(dir = os.path.dirname(path) or '.')
+        f = os.fdopen(fd, 'w+b')
+        try:
+            prettyprint(manifest, f, width = 78)
+        finally:
+            f.close()
+        try:
+            shutil.move(fn, path)
+        except:
+            log.exception("Renaming %s to %s", fn, path)
+            os.remove(fn)
+            raise XendError("Failed to write group manifest %s" % path)
+
+    def _read_grp_manifest(self, path):
+        try:
+            f = open(path)
+            try:
+                return sxp.parse(f)[0]
+            finally:
+                f.close()
+        except (IOError, OSError, IndexError, sxp.ParseError), exn:
+            raise XendError("Unable to read group manifest %s: %s" %
+                            (path, exn))
+
+    def _find_grp_manifest(self, grp):
+        """Find the grp_suspend manifest of a group, by dguuid, name or
+        the dgid the group had when it was suspended.
+        """
+        path = os.path.join(GROUP_SAVE_DIR, str(grp), GROUP_MANIFEST)
+        if os.path.isfile(path):
+            return path
+        if os.path.isdir(GROUP_SAVE_DIR):
+            for dguuid in os.listdir(GROUP_SAVE_DIR):
+                path = os.path.join(GROUP_SAVE_DIR, dguuid, GROUP_MANIFEST)
+                if not os.path.isfile(path):
+                    continue
+                manifest = self._read_grp_manifest(path)
+                if str(grp) in (sxp.child_value(manifest, 'grp_name'),
+                                str(sxp.child_value(manifest, 'dgid'))):
+                    return path
+        raise XendInvalidDomainGroup(str(grp))
+
+##########################################################
+#		restore member images			 #
+##########################################################
+    def _grp_restore_images(self, paths):
+        """Restore the member images of one or more groups together.
+
+        Every image header is read and its domain created first, so that
+        the memory of all members is freed from dom0 by a single balloon
+        call.  The xc_restore processes then run in parallel, each member
+        staying paused until all of them are back, and each group is
+        unpaused with one hypercall.  If a member fails the others are
+        left paused.
+
+        @return: per-member results, named by image path
+        @rtype: list of dict
+        """
+        oflags = os.O_RDONLY
+        if hasattr(os, "O_LARGEFILE"):
+            oflags |= os.O_LARGEFILE
+
+        fds = []
+        pending = []
+        self.xd.policy_lock.acquire_reader()
+        try:
+            try:
+                for path in paths:
+                    try:
+                        fd = os.open(path, oflags)
+                    except OSError, ex:
+                        raise XendError("can't read guest state file %s: %s"
+                                        % (path, ex[1]))
+                    fds.append(fd)
+                    vmconfig, grpconfig, codec = \
+                              XendCheckpoint.read_header(fd)
+                    dominfo, restore_image, memory, shadow = \
+                             XendCheckpoint.restore_create(self.xd, vmconfig,
+                                                           grpconfig)
+                    pending.append((path, fd, dominfo, restore_image,
+                                    memory, shadow,
+                                    sxp.child_value(vmconfig, 'dguuid'),
+                                    codec))
+
+                need = sum([item[4] + item[5] for item in pending])
+                log.debug("Group restore of %d members needs %d KiB",
+                          len(pending), need)
+                if pending:
+                    balloon.free(need, pending[0][2])
+            except:
+                for item in pending:
+                    item[2].destroy()
+                raise
+
+            def restore(item):
+                path, fd, dominfo, restore_image, _, shadow, _, codec = item
+                XendCheckpoint.restore_memory(fd, dominfo, restore_image,
+                                              shadow, paused = True,
+                                              codec = codec)
+
+            results = XendDomainGroupExecutor().run(pending, restore,
+                                                    name = lambda i: i[0])
+        finally:
+            for fd in fds:
+                os.close(fd)
+            self.xd.policy_lock.release()
+
+        if False in [r['ok'] for r in results]:
+            log.error("Group restore failed for: %s; restored members are "
+                      "left paused",
+                      ", ".join([r['member'] for r in results if not r['ok']]))
+            return results
+
+        for dguuid in dict([(item[6], None) for item in pending]).keys():
+            grpinfo = self.grp_lookup(dguuid, force_refresh = True)
+            if grpinfo:
+                grpinfo.unpause()
+            else:
+                log.error("Group %s not found after restore", dguuid)
+        return results
+
 ##########################################################
 #		group save				 #
 ##########################################################
-    def grp_save(self, dgid, prefix):
-        members = self.grp_members(dgid)
-        for dom in members:
-            self.xd.domain_save(dom, prefix + "." + dom)
-        self.grp_destroy(dgid)
+    def grp_save(self, dgid, prefix, checkpoint = False):
+        path_for = lambda domname: "%s.%s" % (prefix, domname)
+        if checkpoint:
+            mode = 'checkpoint'
+        else:
+            mode = 'save'
+        ok, results = self._grp_checkpoint(dgid, path_for,
+                                           prefix + ".manifest", mode)
+        if ok and not checkpoint:
+            self.grp_destroy(dgid)
+        return results
 
 ##########################################################
 #		group restore				 #
 ##########################################################
     def grp_restore(self, srcs):
-        for dompath in srcs:
-            self.xd.domain_restore(dompath, paused=False)
+        return self._grp_restore_images(srcs)
+
+##########################################################
+#		save image catalog			 #
+##########################################################
+    def grp_catalog(self, directory, grp = None):
+        """List the save images in a directory from its catalog, e.g. to
+        pick the paths for grp_restore.
+
+        @param grp: only images of the group with this dguuid or name
+        @return: one dict per image: path, name, uuid, dguuid, grp_name,
+                 memory, hvm, created, mtime, payload_offset, sections
+        @rtype: list of dict
+        """
+        return XendSaveCatalog.query(directory, grp)
 
 ##########################################################
 #		group suspend				 #
 ##########################################################
     def grp_suspend(self, dgid):
-        log.debug("grp_suspend is not working yet")
-    #    members = self.grp_members(dgid)
-    #    for dom in members:
-    #        self.xd.domain_suspend(dom)
-    #    self.grp_destroy(dgid, rmxs=False)
+        grpinfo = self.grp_lookup(dgid, force_refresh = True)
+        if not grpinfo:
+            raise XendInvalidDomainGroup(str(dgid))
+        savedir = os.path.join(GROUP_SAVE_DIR, grpinfo.dguuid)
+        try:
+            mkdir.parents(savedir, stat.S_IRWXU)
+        except:
+            log.exception("%s could not be created." % savedir)
+            raise XendError("%s could not be created." % savedir)
+
+        path_for = lambda domname: os.path.join(savedir, domname + ".chk")
+        ok, results = self._grp_checkpoint(grpinfo.dgid, path_for,
+                                           os.path.join(savedir,
+                                                        GROUP_MANIFEST),
+                                           'suspend')
+        if ok:
+            # keep the group's xenstore entries for grp_resume
+            self.grp_destroy(grpinfo.dgid, rmxs = False)
+        return results
 
 ##########################################################
 #		group resemue				 #
 ##########################################################
-    def grp_resume(self, dgid):
-        log.debug("grp_resume is not working yet")
-    #    member_list_str = self.xst.Read(XS_GRPROOT, "%s/members" % dguuid)
-    #    member_list = member_list_str.split(", ")
-    #    for dom in member_list:
-    #        self.xd.domain_resume(dom)
+    def grp_resume(self, grp):
+        manifest_path = self._find_grp_manifest(grp)
+        manifest = self._read_grp_manifest(manifest_path)
+        paths = [sxp.child_value(m, 'path')
+                 for m in sxp.children(manifest, 'member')]
+
+        results = self._grp_restore_images(paths)
+        if False in [r['ok'] for r in results]:
+            log.error("grp_resume of %s incomplete, keeping %s", grp,
+                      os.path.dirname(manifest_path))
+        else:
+            shutil.rmtree(os.path.dirname(manifest_path), True)
+        return results
 
 ##########################################################
 #		group pasuse				 #
 ##########################################################
     def grp_pause(self, dgid):
-        self.domain_groups_lock.acquire()
-        try:
-            grpinfo = self.grp_lookup(dgid)
-            return grpinfo.pause()
-        finally:
-            self.domain_groups_lock.release()
+        # a single domgrpctl hypercall pauses all members atomically
+        return self._grp_hypercall(dgid, lambda grpinfo: grpinfo.pause())
 
 ##########################################################
 #		group unpasuse				 #
 ##########################################################
     def grp_unpause(self, dgid):
-        self.domain_groups_lock.acquire()
-        try:
-            grpinfo = self.grp_lookup(dgid)
-            return grpinfo.unpause()
-        finally:
-            self.domain_groups_lock.release()
+        return self._grp_hypercall(dgid, lambda grpinfo: grpinfo.unpause())
 
 ##########################################################
 #		group join				 #
@@ -335,52 +770,94 @@ class XendDomainGroup:
     def grp_join(self, domid, dgid):
         self.domain_groups_lock.acquire()
         try:
-            dominfo = self.xd.domain_lookup(domid)
+            dominfo = self.xd.domain_lookup(domid, force_refresh = True)
             old_dgid = dominfo.getDgid()
             rc = xc.domain_group_join(domid, dgid)
             if rc != 0:
                 raise XendError("group_join failed with error: %s" % rc)
-            dominfo = self.xd.domain_lookup(domid)
+            dominfo = self.xd.domain_lookup(domid, force_refresh = True)
             dominfo._storeVmDetails()
             dominfo._storeDomDetails()
             self.xd.managed_config_save(dominfo)
-            grpinfo = self.grp_lookup(dgid)
+            grpinfo = self.grp_lookup(dgid, force_refresh = True)
             grpinfo.storeGrpDetails()
-            old_grpinfo = self.grp_lookup(old_dgid)
+            old_grpinfo = self.grp_lookup_nr(old_dgid)
             old_grpinfo.storeGrpDetails()
             log.debug("dom%s joining grp%s", domid, dgid)
-            return rc
         finally:
             self.domain_groups_lock.release()
+        # the join fails here if the new dgid cannot be saved
+        self.xd.managed_config_flush(dominfo)
+        return rc
 
 ##########################################################
 #		group migrate				 #
 ##########################################################
-    def grp_migrate(self, dgid, dst, live, resource, port):
-
-       def threadHelper(dom):
-            return threading.Thread(target = self.xd.domain_migrate, 
-                                    args = (dom,dst,live,resource,port))
-
-        try:
-            member_names = self.grp_members(dgid)
-            migration_threads = {}
-            # spawn and start a threaded migration request
-            # for each group member
-            for domname in member_names:
-                migration_threads[domname] = threadHelper(domname)
-                migration_threads[domname].start()
-                log.debug("Migration began for domain %s to %s",
-                           domname, dst)
-            # block until all group members finish migration
-            for domname in member_names:
-                migration_threads[domname].join()
-                log.debug("Migration complete for domain %s to %s", 
-                           domname, dst)
-            self.grp_destroy(dgid)
-        except e:
-            log.exception("error during grp_migrate: %s", str(e))
-            self.domain_groups_lock.release()
+    def grp_migrate(self, dgid, dst, live, resource, port, streams = 0):
+        """Migrate every member of a group to dst.
+
+        At most streams members (xend-group-migrate-streams when 0) are
+        migrated at once, largest memory first so that the longest
+        transfers start early.  The group is destroyed only once every
+        member has migrated.  resource is accepted for compatibility
+        and ignored, as in XendDomain.domain_migrate.
+
+        @return: per-member results, see XendDomainGroupExecutor
+        @rtype: list of dict
+        """
+        if not streams:
+            streams = xoptions.get_config_int('xend-group-migrate-streams',
+                                              DEFAULT_MIGRATE_STREAMS)
+
+        members = self._grp_member_domains(dgid)
+        members.sort(key = lambda m: m[1] and m[1].getMemoryTarget() or 0,
+                     reverse = True)
+
+        grpinfo = self.grp_lookup_nr(dgid)
+        progress = dict([(domname, 'queued') for domname, _ in members])
+        self.grp_migrations[grpinfo.dgid] = progress
+
+        def migrate(member):
+            domname, dominfo = member
+            if not dominfo:
+                progress[domname] = 'failed'
+                raise XendError("Group member %s not found" % domname)
+            progress[domname] = 'migrating'
+            log.debug("Migration began for domain %s to %s", domname, dst)
+            try:
+                self.xd.domain_migrate(dominfo.getDomid(), dst, live, port)
+            except:
+                progress[domname] = 'failed'
+                raise
+            progress[domname] = 'done'
+            log.debug("Migration complete for domain %s to %s", domname, dst)
+
+        results = XendDomainGroupExecutor(streams).run(members, migrate,
+                                                       name = lambda m: m[0])
+
+        failed = [r['member'] for r in results if not r['ok']]
+        if failed:
+            log.error("grp_migrate of grp%s to %s failed for: %s",
+                      grpinfo.dgid, dst, ", ".join(failed))
+        else:
+            self.grp_destroy(grpinfo.dgid)
+        return results
+
+##########################################################
+#		group migrate status			 #
+##########################################################
+    def grp_migrate_status(self, dgid):
+        """State of each member in the last grp_migrate of a group:
+        queued, migrating, done or failed."""
+        grpinfo = self.grp_lookup_nr(dgid)
+        if grpinfo:
+            dgid = grpinfo.dgid
+        # the group is gone after a successful migration, so also
+        # accept the numeric dgid as a string
+        for key, progress in self.grp_migrations.items():
+            if str(key) == str(dgid):
+                return dict(progress)
+        raise XendInvalidDomainGroup(str(dgid))
 
 ##########################################################
 #		init constructor			 #
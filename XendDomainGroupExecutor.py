@@ -0,0 +1,29 @@
+#========================================================================
+#
+#		Xend_Domain_Group_Executor
+#
+#========================================================================
+
+"""Runs an operation on every member of a domain group over a bounded
+pool of worker threads, and reports the outcome for each member.
+"""
+
+from xen.xend import XendOptions
+from xen.xend.XendWorkerPool import XendWorkerPool, member_result
+
+xoptions = XendOptions.instance()
+
+DEFAULT_WORKERS = 8
+
+
+class XendDomainGroupExecutor(XendWorkerPool):
+    """A L{XendWorkerPool} sized by xend-group-op-workers."""
+
+    def __init__(self, max_workers = None):
+        if max_workers is None:
+            max_workers = xoptions.get_config_int('xend-group-op-workers',
+                                                  DEFAULT_WORKERS)
+        XendWorkerPool.__init__(self, max_workers)
+
+    def run(self, items, op, name = str, what = "Group operation"):
+        return XendWorkerPool.run(self, items, op, name, what)
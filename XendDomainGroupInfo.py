@@ -94,7 +94,7 @@ class XendDomainGroupInfo:
     """
     def __init__(self, info):
 
-       self.info = info
+        self.info = info
 
         if self.infoIsSet('dgid'):
             self.dgid = self.info['dgid']
@@ -111,6 +111,9 @@ class XendDomainGroupInfo:
             self.info['grp_path'] = "%s%s" % (XS_GRPROOT,self.dguuid)
         self.grppath = self.info['grp_path']
 
+        # details last written to xenstore by storeGrpDetails
+        self.stored_details = None
+
         self.parse_member_list()
         self.validateInfo()
 
@@ -168,7 +171,9 @@ class XendDomainGroupInfo:
             info = xdg.grp_lookup(self.dgid)
             if not info:
                 return
-            
+
+        old_name = self.info.get('grp_name')
+        old_dguuid = self.info.get('dguuid')
         self.info.update(info)
         self.dgid = self.info['dgid']
         self.dguuid = self.info['dguuid']
@@ -176,6 +181,10 @@ class XendDomainGroupInfo:
         self.parse_member_list()
         self.validateInfo()
 
+        if old_name != self.grp_name or old_dguuid != self.dguuid:
+            xdg = xen.xend.XendDomainGroup.instance()
+            xdg._reindex_domain_group(self, old_name, old_dguuid)
+
         log.trace("XendDomainGroupInfo.update done on grp %d: %s", self.dgid, 
                   self.info)
 
@@ -207,19 +216,44 @@ class XendDomainGroupInfo:
         return xstransact.Remove(self.grppath, *args)
 
 
-    def storeGrpDetails(self):
-        to_store = { 
-                     'dgid': str(self.dgid),
-                     'dguuid': self.dguuid,
-                     'grp_name': self.grp_name,
-                     'members': ", ".join(self.members)
-                   }
-        self._writeGrp(to_store)
+    def _writeGrpTxn(self, transaction, to_store):
+        for key, val in to_store.items():
+            transaction.write("%s/%s" % (self.grppath, key), val)
+
+
+    def grpDetails(self):
+        return { 
+                 'dgid': str(self.dgid),
+                 'dguuid': self.dguuid,
+                 'grp_name': self.grp_name,
+                 'members': ", ".join(self.members)
+               }
+
+
+    def grpDetailsDirty(self):
+        """True if the details differ from those last written by
+        storeGrpDetails."""
+        return self.stored_details != self.grpDetails()
+
+
+    def invalidateGrpDetails(self):
+        """Forget the last written details, e.g. after the transaction
+        that wrote them was aborted, so the next store rewrites them."""
+        self.stored_details = None
+
+
+    def storeGrpDetails(self, transaction = None):
+        to_store = self.grpDetails()
+        if transaction:
+            self._writeGrpTxn(transaction, to_store)
+        else:
+            self._writeGrp(to_store)
+        self.stored_details = to_store
 
 
     # create an empty group
     def construct(self, dguuid = None):
-       if dguuid:
+        if dguuid:
             dg_handle = uuid.fromString(dguuid)
         else:
             dg_handle = uuid.fromString(self.info['dguuid'])
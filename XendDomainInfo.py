@@ -40,6 +40,7 @@ from xen.xend.XendConfig import scrub_password
 from xen.xend.XendBootloader import bootloader, bootloader_tidy
 from xen.xend.XendError import XendError, VmError
 from xen.xend.XendDevices import XendDevices
+from xen.xend.XendWorkerPool import XendWorkerPool
 from xen.xend.XendTask import XendTask
 from xen.xend.xenstore.xstransact import xstransact, complete
 from xen.xend.xenstore.xsutil import GetDomainPath, IntroduceDomain, SetTarget, ResumeDomain
@@ -59,6 +60,12 @@ from xen.xend.XendDSCSI import XendDSCSI, XendDSCSI_HBA
 
 MIGRATE_TIMEOUT = 30.0
 BOOTLOADER_LOOPBACK_DEVICE = '/dev/xvdp'
+# seconds a guest gets to acknowledge a suspend request
+SUSPEND_TIMEOUT = 60
+# device classes whose controllers may migrate concurrently with others
+PARALLEL_MIGRATE_CLASSES = ('vbd', 'vif', 'pci', 'vscsi', 'vusb', 'console')
+# state waits are woken by events; this only bounds a missed one
+STATE_RECHECK_INTERVAL = 1.0
 
 xc = xen.lowlevel.xc.xc()
 xoptions = XendOptions.instance()
@@ -425,6 +432,8 @@ class XendDomainInfo:
         self.vmWatch = None
         self.shutdownWatch = None
         self.shutdownStartTime = None
+        self.suspendRequestTime = None
+        self.lastSuspendLatency = None
         self._resume = resume
         self.restart_in_progress = False
 
@@ -518,6 +527,8 @@ class XendDomainInfo:
         
         if reason not in DOMAIN_SHUTDOWN_REASONS.values():
             raise XendError('Invalid reason: %s' % reason)
+        if reason == 'suspend':
+            self.suspendRequestTime = time.time()
         self.storeDom("control/shutdown", reason)
 
         # HVM domain shuts itself down only if it has PV drivers
@@ -864,6 +875,7 @@ class XendDomainInfo:
                 self._waitForDevice(dev_type, devid)
             except VmError, ex:
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
                 if dev_type == 'pci':
                     for dev in dev_config_dict['devs']:
                         XendAPIStore.deregister(dev['uuid'], 'DPCI')
@@ -917,7 +929,8 @@ class XendDomainInfo:
             from xen.xend import XendDomain
             if pci_state == 'Initialising':
                 if stubdomid is not None :
-                    XendDomain.instance().domain_lookup(stubdomid).pci_device_configure(dev_sxp[:])
+                    XendDomain.instance().domain_lookup(stubdomid,
+                        force_refresh = True).pci_device_configure(dev_sxp[:])
 
                 # HVM PCI device attachment
                 if pci_sub_state == 'Booting':
@@ -950,7 +963,8 @@ class XendDomainInfo:
                 if (PCI_FUNC(int(new_dev['vdevfn'], 16)) == 0):
                     self.hvm_destroyPCIDevice(new_dev)
                 if stubdomid is not None :
-                    XendDomain.instance().domain_lookup(stubdomid).pci_device_configure(dev_sxp[:])
+                    XendDomain.instance().domain_lookup(stubdomid,
+                        force_refresh = True).pci_device_configure(dev_sxp[:])
                 # Update vdevfn
                 dev['vdevfn'] = new_dev['vdevfn']
                 for n in sxp.children(pci_dev):
@@ -972,6 +986,7 @@ class XendDomainInfo:
             existing_pci_conf = self.info['devices'][existing_dev_uuid][1]
             devid = self._createDevice('pci', existing_pci_conf)
             self.info['devices'][existing_dev_uuid][1]['devid'] = devid
+            self.info.changed()
 
         if self.domid is not None:
             # use DevController.reconfigureDevice to change device config
@@ -994,6 +1009,7 @@ class XendDomainInfo:
                 else:
                     self.destroyDevice('pci', devid)
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
         else:
             new_dev_sxp = ['pci']
             for cur_dev in sxp.children(existing_dev_info, 'dev'):
@@ -1015,6 +1031,7 @@ class XendDomainInfo:
             # If there is no device left, remove config.
             if len(sxp.children(new_dev_sxp, 'dev')) == 0:
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
 
         xen.xend.XendDomain.instance().managed_config_save(self)
 
@@ -1109,6 +1126,7 @@ class XendDomainInfo:
             if num_devs == 0:
                 self.destroyDevice('vscsi', req_devid)
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
 
         else:
             new_dev_sxp = ['vscsi']
@@ -1138,6 +1156,7 @@ class XendDomainInfo:
             # If there is only 'vscsi' in new_dev_sxp, remove the config.
             if len(sxp.children(new_dev_sxp, 'dev')) == 0:
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
 
         xen.xend.XendDomain.instance().managed_config_save(self)
 
@@ -1342,6 +1361,7 @@ class XendDomainInfo:
             dev_uuid = sxp.child_value(dev_info, 'uuid')
             del self.info['devices'][dev_uuid]
             self.info['%s_refs' % deviceClass].remove(dev_uuid)
+            self.info.changed()
             xen.xend.XendDomain.instance().managed_config_save(self)
 
         return rc
@@ -1843,6 +1863,8 @@ class XendDomainInfo:
         # convert two lists into a python dictionary
         vm_details = dict(zip(cfg_vm, vm_details))
 
+        old_name = self.info['name_label']
+
         for arg, val in vm_details.items():
             if arg in XendConfig.LEGACY_CFG_TO_XENAPI_CFG:
                 xapiarg = XendConfig.LEGACY_CFG_TO_XENAPI_CFG[arg]
@@ -1867,7 +1889,13 @@ class XendDomainInfo:
         # Update the rtc_timeoffset to be preserved across reboot.
         # NB. No need to update xenstore domain section.
         val = int(vm_details.get("rtc/timeoffset", 0))
-        self.info["platform"]["rtc_timeoffset"] = val
+        if self.info["platform"].get("rtc_timeoffset") != val:
+            self.info["platform"]["rtc_timeoffset"] = val
+            self.info.changed()
+
+        if self.info['name_label'] != old_name:
+            from xen.xend import XendDomain
+            XendDomain.instance().reindex_domain(self)
  
         if changed:
             # Update the domain section of the store, as this contains some
@@ -1887,8 +1915,11 @@ class XendDomainInfo:
         
         reason = self.readDom('control/shutdown')
 
-	   # stash current dgid for restart domain using
-	    self.old_dgid = self.info.get('dgid')
+        # stash current dgid for restart domain using
+        self.old_dgid = self.info.get('dgid')
+
+        # a guest acknowledging a suspend request rewrites control/shutdown
+        self._notifyStateWaiters()
 
         if reason and reason != 'suspend':
             sst = self.readDom('xend/shutdown_start_time')
@@ -1938,8 +1969,11 @@ class XendDomainInfo:
         return None
 
     def setName(self, name, to_store = True):
+        from xen.xend import XendDomain
+
         self._checkName(name)
         self.info['name_label'] = name
+        XendDomain.instance().reindex_domain(self)
         if to_store:
             self.storeVm("name", name)
 
@@ -2022,12 +2056,14 @@ class XendDomainInfo:
 
     def setCap(self, cpu_cap):
         self.info['vcpus_params']['cap'] = cpu_cap
+        self.info.changed()
 
     def getWeight(self):
         return self.info['vcpus_params']['weight']
 
     def setWeight(self, cpu_weight):
         self.info['vcpus_params']['weight'] = cpu_weight
+        self.info.changed()
 
     def getRestartCount(self):
         return self._readVm('xend/restart_count')
@@ -2267,7 +2303,8 @@ class XendDomainInfo:
         keep this domain for debugging, but restart a new one in its place
         preserving the restart semantics (name and UUID preserved).
         """
-        
+        from xen.xend import XendDomain
+
         new_uuid = uuid.createString()
         new_name = 'Domain-%s' % new_uuid
         log.info("Renaming dead domain %s (%d, %s) to %s (%s).",
@@ -2282,6 +2319,7 @@ class XendDomainInfo:
         new_dom_info['uuid'] = self.info['uuid']
         self.info['name_label'] = new_name
         self.info['uuid'] = new_uuid
+        XendDomain.instance().reindex_domain(self)
         self.vmpath = XS_VMROOT + new_uuid
         # Write out new vm node to xenstore
         self._storeVmDetails()
@@ -2394,6 +2432,7 @@ class XendDomainInfo:
                     # store devid in XendConfig for caching reasons
                     if dev_uuid in self.info['devices']:
                         self.info['devices'][dev_uuid][1]['devid'] = devid
+                        self.info.changed()
 
             elif devclass == 'vscsi':
                 vscsi_config = config.get('devs', [])[0]
@@ -2414,6 +2453,7 @@ class XendDomainInfo:
                 # store devid in XendConfig for caching reasons
                 if dev_uuid in self.info['devices']:
                     self.info['devices'][dev_uuid][1]['devid'] = devid
+                    self.info.changed()
 
 
         if self.image:
@@ -2480,22 +2520,62 @@ class XendDomainInfo:
                 raise XendError("Device of type '%s' refuses migration." % n)
 
     def migrateDevices(self, network, dst, step, domName=''):
-        """Notify the devices about migration
+        """Notify the devices about migration.
+
+        The classes in PARALLEL_MIGRATE_CLASSES have controllers that
+        share no state, so they are notified concurrently unless
+        xend-device-migrate-parallel is off; the other classes are
+        notified one at a time after them.  The devices of one class are
+        notified in config order.  If any device fails, the devices that
+        completed this step are recovered from it and all others from
+        the step before.
+
+        @return: one result per device class notified, see XendWorkerPool
+        @rtype: list of dict
+        @raise XendError: a device failed this step
         """
-        ctr = 0
-        try:
-            for (dev_type, dev_conf) in self.info.all_devices_sxpr():
-                self.migrateDevice(dev_type, dev_conf, network, dst,
-                                   step, domName)
-                ctr = ctr + 1
-        except:
-            for dev_type, dev_conf in self.info.all_devices_sxpr():
-                if ctr == 0:
-                    step = step - 1
-                ctr = ctr - 1
+        devices = self.info.all_devices_sxpr()
+        classes = []
+        for (dev_type, _) in devices:
+            if dev_type not in classes:
+                classes.append(dev_type)
+
+        done = []
+        def migrate_class(dev_class):
+            for i, (dev_type, dev_conf) in enumerate(devices):
+                if dev_type == dev_class:
+                    self.migrateDevice(dev_type, dev_conf, network, dst,
+                                       step, domName)
+                    done.append(i)
+
+        what = "Device migration step %d of %s" % (step,
+                                                   self.info['name_label'])
+        if xoptions.get_config_bool('xend-device-migrate-parallel', True):
+            parallel = [c for c in classes if c in PARALLEL_MIGRATE_CLASSES]
+        else:
+            parallel = []
+        serial = [c for c in classes if c not in parallel]
+
+        results = XendWorkerPool(len(parallel)).run(parallel, migrate_class,
+                                                    what = what)
+        failed = [r for r in results if not r['ok']]
+        if not failed:
+            results += XendWorkerPool(1).run(serial, migrate_class,
+                                             what = what)
+            failed = [r for r in results if not r['ok']]
+        if failed:
+            for i, (dev_type, dev_conf) in enumerate(devices):
+                if i in done:
+                    recover_step = step
+                else:
+                    recover_step = step - 1
                 self._recoverMigrateDevice(dev_type, dev_conf, network,
-                                           dst, step, domName)
-            raise
+                                           dst, recover_step, domName)
+            raise XendError("Device migration step %d failed: %s" %
+                            (step, "; ".join(["%s: %s" % (r['member'],
+                                                          r['error'])
+                                              for r in failed])))
+        return results
 
     def migrateDevice(self, deviceClass, deviceConfig, network, dst,
                       step, domName=''):
@@ -2968,38 +3048,97 @@ class XendDomainInfo:
         except:
             log.exception("Unwatching control/shutdown failed.")
 
+    def _notifyStateWaiters(self):
+        self.state_updated.acquire()
+        try:
+            self.state_updated.notifyAll()
+        finally:
+            self.state_updated.release()
+
+    def _startStateWaker(self, deadline = None):
+        """Start the one thread of a wait call that wakes the state
+        waiters at deadline, and every STATE_RECHECK_INTERVAL in case an
+        event was missed.
+
+        The waiters themselves block in an untimed Condition.wait, which
+        wakes as soon as it is notified, where a timed one polls.
+
+        @return: Event to set once the wait is over
+        @rtype: threading.Event
+        """
+        done = threading.Event()
+
+        def wake(deadline):
+            while not done.isSet():
+                interval = STATE_RECHECK_INTERVAL
+                if deadline is not None:
+                    interval = max(0, min(interval, deadline - time.time()))
+                    if interval < STATE_RECHECK_INTERVAL:
+                        deadline = None
+                done.wait(interval)
+                if not done.isSet():
+                    self._notifyStateWaiters()
+
+        thread = threading.Thread(target = wake, args = (deadline,))
+        thread.setDaemon(True)
+        thread.start()
+        return done
+
     def waitForShutdown(self):
+        waker = self._startStateWaker()
         self.state_updated.acquire()
         try:
             while self._stateGet() in (DOM_STATE_RUNNING,DOM_STATE_PAUSED):
-                self.state_updated.wait(timeout=1.0)
+                self.state_updated.wait()
         finally:
             self.state_updated.release()
+            waker.set()
 
-    def waitForSuspend(self):
+    def waitForSuspend(self, timeout = None):
         """Wait for the guest to respond to a suspend request by
         shutting down.  If the guest hasn't re-written control/shutdown
         after a certain amount of time, it's obviously not listening and
         won't suspend, so we give up.  HVM guests with no PV drivers
         should already be shutdown.
+
+        Wakes on the control/shutdown watch and on the state changes made
+        by refreshShutdown rather than polling.
+
+        @param timeout: seconds the guest gets to acknowledge the request;
+                        defaults to xend-suspend-timeout
+        @return: seconds from the suspend request to the domain being
+                 suspended
+        @rtype: float
         """
-        state = "suspend"
-        nr_tries = 60
+        if timeout is None:
+            timeout = xoptions.get_config_int('xend-suspend-timeout',
+                                              SUSPEND_TIMEOUT)
+        deadline = time.time() + timeout
+        acknowledged = False
 
+        waker = self._startStateWaker(deadline)
         self.state_updated.acquire()
         try:
             while self._stateGet() in (DOM_STATE_RUNNING,DOM_STATE_PAUSED):
-                self.state_updated.wait(1.0)
-                if state == "suspend":
-                    if nr_tries == 0:
-                        msg = ('Timeout waiting for domain %s to suspend'
-                            % self.domid)
-                        self._writeDom('control/shutdown', '')
-                        raise XendError(msg)
-                    state = self.readDom('control/shutdown')
-                    nr_tries -= 1
+                if not acknowledged:
+                    acknowledged = \
+                        self.readDom('control/shutdown') != "suspend"
+                if not acknowledged and time.time() >= deadline:
+                    msg = ('Timeout waiting for domain %s to suspend'
+                        % self.domid)
+                    self._writeDom('control/shutdown', '')
+                    raise XendError(msg)
+                self.state_updated.wait()
         finally:
             self.state_updated.release()
+            waker.set()
+
+        if self.suspendRequestTime:
+            self.lastSuspendLatency = time.time() - self.suspendRequestTime
+            self.suspendRequestTime = None
+            log.info("Domain %s suspended %.1fms after the request.",
+                     self.domid, self.lastSuspendLatency * 1000)
+        return self.lastSuspendLatency
 
     #
     # TODO: recategorise - called from XendCheckpoint
@@ -3544,11 +3683,11 @@ class XendDomainInfo:
                   str(self.domid), self.info)
 
     def sxpr(self, ignore_store = False, legacy_only = True):
-        result = self.info.to_sxp(domain = self,
-                                  ignore_devices = ignore_store,
-                                  legacy_only = legacy_only)
-
-        return result
+        """Get the SXP representation of this domain, as last built if
+        nothing changed since; callers copy it before changing it."""
+        return self.info.to_sxp_snapshot(self,
+                                         ignore_devices = ignore_store,
+                                         legacy_only = legacy_only)
 
     # Xen API
     # ----------------------------------------------------------------
@@ -3912,6 +4051,7 @@ class XendDomainInfo:
 
     def set_dev_property(self, dev_class, dev_uuid, field, value):
         self.info['devices'][dev_uuid][1][field] = value
+        self.info.changed()
 
     def get_vcpus_util(self):
         vcpu_util = {}
@@ -3980,6 +4120,7 @@ class XendDomainInfo:
                 log.exception(exn)
                 del self.info['devices'][dev_uuid]
                 self.info['vbd_refs'].remove(dev_uuid)
+                self.info.changed()
                 raise
             
         return dev_uuid
@@ -4029,6 +4170,7 @@ class XendDomainInfo:
                 log.exception(exn)
                 del self.info['devices'][dev_uuid]
                 self.info['vif_refs'].remove(dev_uuid)
+                self.info.changed()
                 raise            
  
         return dev_uuid
@@ -4281,6 +4423,7 @@ class XendDomainInfo:
         finally:
             del self.info['devices'][dev_uuid]
             self.info['%s_refs' % dev_type].remove(dev_uuid)
+            self.info.changed()
 
     def destroy_vbd(self, dev_uuid):
         self.destroy_device_by_uuid('vbd', dev_uuid)
@@ -4321,6 +4464,7 @@ class XendDomainInfo:
             self.info.device_update(dev_uuid, new_pci_sxp)
             if len(sxp.children(new_pci_sxp, 'dev')) == 0:
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
             xen.xend.XendDomain.instance().managed_config_save(self)
 
         else:
@@ -4356,6 +4500,7 @@ class XendDomainInfo:
             self.info.device_update(dev_uuid, new_vscsi_sxp)
             if len(sxp.children(new_vscsi_sxp, 'dev')) == 0:
                 del self.info['devices'][dev_uuid]
+                self.info.changed()
             xen.xend.XendDomain.instance().managed_config_save(self)
 
         else:
@@ -4375,6 +4520,7 @@ class XendDomainInfo:
             new_vscsi_sxp = ['vscsi', ['feature-host', feature_host]]
             self.info.device_update(dev_uuid, new_vscsi_sxp)
             del self.info['devices'][dev_uuid]
+            self.info.changed()
             xen.xend.XendDomain.instance().managed_config_save(self)
         else:
             # If feature_host is 1, all devices are destroyed by just
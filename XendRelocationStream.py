@@ -0,0 +1,431 @@
+#########################################################################
+#									#
+#			  Xend Relocation Stream			#
+#									#
+#########################################################################
+
+"""Striping of a relocation stream over several connections.
+
+A migration asks the destination for up to xend-relocation-streams
+connections in its receive or sslreceive request:
+
+    (receive (streams N))
+
+A destination that stripes answers
+
+    (ready receive (streams M) (session S))
+
+with M <= N, and the source opens M - 1 more connections, each starting
+with (receive-stream (session S)).  An older destination answers
+(ready receive) and gets the plain single stream, as does every
+destination when N is 1.
+
+On a striped migration the save stream is cut into chunks sent as
+CHUNK_HEADER (sequence number, length) and the data, each on whichever
+connection is free first; every connection ends with an empty chunk.
+The destination puts the chunks back in order before restore reads
+them.
+"""
+
+import os
+import Queue
+import threading
+from struct import pack, unpack, calcsize
+
+from xen.xend import sxp
+from xen.xend import XendOptions
+from xen.xend.XendCheckpointStream import CheckpointStream
+from xen.xend.XendError import XendError
+from xen.xend.XendLogging import log
+
+DEFAULT_STREAMS = 1
+MAX_STREAMS = 16
+
+CHUNK_SIZE = 1 << 20
+CHUNK_HEADER = "!QI"
+sizeof_chunk_header = calcsize(CHUNK_HEADER)
+
+# chunks per stream the destination holds while waiting for a late one
+REORDER_CHUNKS = 4
+# seconds the destination waits for the extra connections
+STREAM_TIMEOUT = 30.0
+# no handshake reply is longer than this
+MAX_REPLY = 1024
+
+xoptions = XendOptions.instance()
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def configured_streams():
+    return max(1, min(MAX_STREAMS,
+                      xoptions.get_config_int('xend-relocation-streams',
+                                              DEFAULT_STREAMS)))
+
+
+def _recv_exact(sock, size):
+    data = []
+    while size:
+        buf = sock.recv(min(size, CHUNK_SIZE))
+        if not buf:
+            raise XendError("relocation stream closed early")
+        data.append(buf)
+        size -= len(buf)
+    return "".join(data)
+
+
+def _read_sxp(sock):
+    """Read one sxp value from sock, a byte at a time so that nothing
+    after it is consumed."""
+    p = sxp.Parser()
+    for _ in range(MAX_REPLY):
+        c = sock.recv(1)
+        if not c:
+            break
+        p.input(c)
+        if p.ready():
+            return p.get_val()
+    raise XendError("bad relocation handshake")
+
+
+def _start(target, *args):
+    thread = threading.Thread(target = target, args = args)
+    thread.setDaemon(True)
+    thread.start()
+    return thread
+
+
+#########################################################################
+#			  Source side					#
+#########################################################################
+def connect(open_connection, op, streams = None):
+    """Open the connections of a relocation, striped if the destination
+    agrees.
+
+    @param open_connection: callable returning a new connected socket
+    @param op: 'receive' or 'sslreceive'
+    @param streams: connections to ask for; xend-relocation-streams when
+                    None
+    @return: the sockets, the one the handshake ran on first
+    @rtype: list
+    """
+    if streams is None:
+        streams = configured_streams()
+    socks = [open_connection()]
+    try:
+        # a list request ends at its closing bracket, so nothing may
+        # follow it before the stream; a bare word needs the newline
+        if streams > 1:
+            socks[0].sendall(sxp.to_string([op, ['streams', streams]]))
+        else:
+            socks[0].sendall(op + "\n")
+        reply = _read_sxp(socks[0])
+        if not isinstance(reply, list) or sxp.name(reply) != 'ready':
+            raise XendError("relocation refused: %s" % sxp.to_string(reply))
+        session = sxp.child_value(reply, 'session')
+        count = min(streams, int(sxp.child_value(reply, 'streams', 1)))
+        for _ in range(1, count):
+            sock = open_connection()
+            socks.append(sock)
+            sock.sendall(sxp.to_string(['receive-stream',
+                                        ['session', session]]))
+            _read_sxp(sock)
+    except:
+        for sock in socks:
+            sock.close()
+        raise
+    log.debug("Relocation %s over %d connections", op, len(socks))
+    return socks
+
+
+class StripeSender:
+    """Sends what is written to fd over socks as sequence numbered
+    chunks.
+
+    @ivar fd: the pipe end to save into
+    """
+
+    def __init__(self, socks):
+        self.socks = socks
+        self.error = None
+        self.chunks = Queue.Queue(2 * len(socks))
+        self.read_fd, self.fd = os.pipe()
+        self.threads = [_start(self._split)] + \
+                       [_start(self._send, sock) for sock in socks]
+
+    def _fail(self, exn):
+        if self.error is None:
+            log.exception("Relocation stream failed")
+            self.error = exn
+
+    def _split(self):
+        seq = 0
+        try:
+            try:
+                while self.error is None:
+                    data = os.read(self.read_fd, CHUNK_SIZE)
+                    if not data:
+                        break
+                    self.chunks.put((seq, data))
+                    seq += 1
+            except Exception, exn:
+                self._fail(exn)
+        finally:
+            # stopping early fails the saver with EPIPE
+            os.close(self.read_fd)
+            for _ in self.socks:
+                self.chunks.put(None)
+
+    def _send(self, sock):
+        # keeps draining after a failure so that _split never blocks
+        while True:
+            item = self.chunks.get()
+            if item is None:
+                break
+            if self.error is None:
+                seq, data = item
+                try:
+                    sock.sendall(pack(CHUNK_HEADER, seq, len(data)))
+                    sock.sendall(data)
+                except Exception, exn:
+                    self._fail(exn)
+        if self.error is None:
+            try:
+                sock.sendall(pack(CHUNK_HEADER, 0, 0))
+            except Exception, exn:
+                self._fail(exn)
+
+    def close(self):
+        """Close fd and wait for everything written to it to be sent.
+
+        @raise XendError: a connection failed
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        for thread in self.threads:
+            thread.join()
+        if self.error:
+            raise XendError("Relocation stream failed: %s" % self.error)
+
+
+#########################################################################
+#			  Destination side				#
+#########################################################################
+class StripeReceiver:
+    """Reassembles the chunks arriving on socks, in order, into the pipe
+    read at fd.
+
+    @ivar fd: the pipe end to restore from
+    """
+
+    def __init__(self, socks):
+        self.error = None
+        self.pending = {}
+        self.next = 0
+        self.open_streams = len(socks)
+        self.window = REORDER_CHUNKS * len(socks)
+        self.cond = threading.Condition()
+        self.fd, self.write_fd = os.pipe()
+        self.writer = _start(self._write)
+        for sock in socks:
+            _start(self._receive, sock)
+
+    def _fail(self, exn):
+        self.cond.acquire()
+        try:
+            if self.error is None:
+                log.exception("Relocation stream failed")
+                self.error = exn
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _receive(self, sock):
+        try:
+            try:
+                while True:
+                    seq, size = unpack(CHUNK_HEADER,
+                                       _recv_exact(sock, sizeof_chunk_header))
+                    if not size:
+                        break
+                    if size > CHUNK_SIZE:
+                        raise XendError("bad relocation chunk of %d bytes" %
+                                        size)
+                    data = _recv_exact(sock, size)
+                    self.cond.acquire()
+                    try:
+                        # a chunk this far ahead waits for the ones before
+                        while seq >= self.next + self.window and \
+                              self.error is None:
+                            self.cond.wait()
+                        if self.error is not None:
+                            return
+                        self.pending[seq] = data
+                        self.cond.notifyAll()
+                    finally:
+                        self.cond.release()
+            except Exception, exn:
+                self._fail(exn)
+        finally:
+            self.cond.acquire()
+            try:
+                self.open_streams -= 1
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def _write(self):
+        out = CheckpointStream(self.write_fd)
+        try:
+            try:
+                while True:
+                    self.cond.acquire()
+                    try:
+                        while self.next not in self.pending and \
+                              self.open_streams and self.error is None:
+                            self.cond.wait()
+                        if self.error is not None:
+                            return
+                        data = self.pending.pop(self.next, None)
+                        if data is None:
+                            if self.pending:
+                                raise XendError("relocation chunk %d lost" %
+                                                self.next)
+                            return
+                        self.next += 1
+                        self.cond.notifyAll()
+                    finally:
+                        self.cond.release()
+                    out.write_exact(data, "could not pass on relocation data")
+            except Exception, exn:
+                self._fail(exn)
+        finally:
+            os.close(self.write_fd)
+
+    def close(self):
+        """Close fd and wait for the reassembly to end.
+
+        @raise XendError: a connection failed
+        """
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.writer.join()
+        if self.error:
+            raise XendError("Relocation stream failed: %s" % self.error)
+
+
+class ReceiveSession:
+    """The connections of one striped relocation to this host.
+
+    @ivar id: session id the source quotes on its extra connections
+    @ivar streams: number of connections agreed on
+    """
+
+    def __init__(self, sock, streams):
+        self.id = os.urandom(8).encode('hex')
+        self.streams = streams
+        self.socks = [sock]
+        self.receiver = None
+        self.cond = threading.Condition()
+        self.done = False
+
+    def _add(self, sock):
+        self.cond.acquire()
+        try:
+            if self.done or self.receiver or \
+               len(self.socks) >= self.streams:
+                raise XendError("relocation session %s is full" % self.id)
+            self.socks.append(sock)
+            sock.sendall(sxp.to_string(['ready', 'receive-stream']))
+            self.cond.notifyAll()
+            while not self.done:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def open(self):
+        """Wait for the extra connections and start reassembling.
+
+        @return: fd to restore from
+        @raise XendError: a connection did not arrive in time
+        """
+        self.cond.acquire()
+        try:
+            while len(self.socks) < self.streams:
+                before = len(self.socks)
+                self.cond.wait(STREAM_TIMEOUT)
+                if len(self.socks) == before:
+                    raise XendError("relocation session %s got %d of %d "
+                                    "connections" % (self.id, before,
+                                                     self.streams))
+            self.receiver = StripeReceiver(self.socks)
+        finally:
+            self.cond.release()
+        return self.receiver.fd
+
+    def close(self):
+        """End the session, releasing its extra connections.
+
+        @raise XendError: a connection failed
+        """
+        _sessions_lock.acquire()
+        try:
+            _sessions.pop(self.id, None)
+        finally:
+            _sessions_lock.release()
+        try:
+            if self.receiver:
+                self.receiver.close()
+        finally:
+            self.cond.acquire()
+            try:
+                self.done = True
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+
+def accept(sock, req):
+    """Answer a receive or sslreceive request on sock.
+
+    @return: the session the rest of the relocation arrives in, or None
+             for a plain single stream on sock
+    @rtype: ReceiveSession
+    """
+    op = sxp.name(req)
+    try:
+        wanted = int(sxp.child_value(req, 'streams', 1))
+    except ValueError:
+        wanted = 1
+    streams = min(wanted, configured_streams())
+    if streams <= 1:
+        sock.sendall(sxp.to_string(['ready', op]))
+        return None
+
+    session = ReceiveSession(sock, streams)
+    _sessions_lock.acquire()
+    try:
+        _sessions[session.id] = session
+    finally:
+        _sessions_lock.release()
+    sock.sendall(sxp.to_string(['ready', op, ['streams', streams],
+                                ['session', session.id]]))
+    return session
+
+
+def join(sock, req):
+    """Serve a receive-stream request: hand sock to its session and block
+    until the session ends, as sock must stay open until then.
+    """
+    _sessions_lock.acquire()
+    try:
+        session = _sessions.get(sxp.child_value(req, 'session'))
+    finally:
+        _sessions_lock.release()
+    if session is None:
+        raise XendError("no relocation session %s" %
+                        sxp.child_value(req, 'session'))
+    session._add(sock)
@@ -0,0 +1,205 @@
+#########################################################################
+#									#
+#			  Xend Save Catalog				#
+#									#
+#########################################################################
+
+"""An index of the save images in a directory, kept in CATALOG_FILE next
+to them.  Entries are built from the image headers alone (see
+XendCheckpointHeader), so a group restore can be planned without reading
+any image payload.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from xen.xend import sxp
+from xen.xend import XendCheckpointHeader
+from xen.xend.XendCheckpointHeader import HEADER_SIGNATURE, \
+     SECTION_VMCONFIG, SECTION_GRPCONFIG
+from xen.xend.PrettyPrint import prettyprint
+from xen.xend.XendError import XendError
+from xen.xend.XendLogging import log
+
+CATALOG_FILE = "xend-catalog.sxp"
+
+SECTION_NAMES = {SECTION_VMCONFIG: 'vmconfig',
+                 SECTION_GRPCONFIG: 'grpconfig'}
+
+# image fields and their types, in catalog order
+ENTRY_FIELDS = [('name', str),
+                ('uuid', str),
+                ('dguuid', str),
+                ('grp_name', str),
+                ('memory', int),
+                ('hvm', int),
+                ('created', int),
+                ('mtime', int),
+                ('payload_offset', int)]
+
+# serialises catalog updates from parallel group saves
+_lock = threading.Lock()
+
+
+def image_entry(path):
+    """Build the catalog entry of one save image from its header.
+
+    @rtype: dict
+    @raise XendError: not a save image
+    """
+    header = XendCheckpointHeader.read_image_header(path)
+    vmconfig = XendCheckpointHeader.parse_sxp(
+        header.sections[SECTION_VMCONFIG], "config")
+    grpconfig = XendCheckpointHeader.decode_group_config(
+        header.sections[SECTION_GRPCONFIG])
+    image = sxp.child_value(vmconfig, 'image')
+    st = os.stat(path)
+
+    sections = {}
+    for kind, (offset, size, _) in header.table.items():
+        sections[SECTION_NAMES.get(kind, str(kind))] = [offset, size]
+
+    return {'path': os.path.basename(path),
+            'name': sxp.child_value(vmconfig, 'name', ''),
+            'uuid': sxp.child_value(vmconfig, 'uuid', ''),
+            'dguuid': grpconfig['dguuid'] or '',
+            'grp_name': grpconfig['grp_name'] or '',
+            'memory': int(sxp.child_value(vmconfig, 'memory', 0)),
+            'hvm': int(bool(image) and sxp.name(image) == 'hvm'),
+            'created': int(st.st_mtime),
+            'mtime': int(st.st_mtime),
+            'payload_offset': header.size,
+            'sections': sections}
+
+
+def _catalog_path(directory):
+    return os.path.join(directory, CATALOG_FILE)
+
+
+def _load(directory):
+    entries = {}
+    path = _catalog_path(directory)
+    if not os.path.isfile(path):
+        return entries
+    try:
+        f = open(path)
+        try:
+            catalog = sxp.parse(f)[0]
+        finally:
+            f.close()
+        for image in sxp.children(catalog, 'image'):
+            entry = {'path': sxp.child_value(image, 'path')}
+            for field, conv in ENTRY_FIELDS:
+                entry[field] = conv(sxp.child_value(image, field))
+            entry['sections'] = {}
+            for section in sxp.children(sxp.child(image, 'sections')
+                                        or ['sections']):
+                entry['sections'][section[0]] = map(int, section[1:3])
+            entries[entry['path']] = entry
+    except Exception, exn:
+        # a damaged catalog is rebuilt from the image headers
+        log.warn("Ignoring unreadable save catalog %s: %s", path, exn)
+        return {}
+    return entries
+
+
+def _store(directory, entries):
+    catalog = ['catalog']
+    names = entries.keys()
+    names.sort()
+    for name in names:
+        entry = entries[name]
+        image = ['image', ['path', entry['path']]]
+        image += [[field, entry[field]] for field, _ in ENTRY_FIELDS]
+        image.append(['sections'] + [[kind] + entry['sections'][kind]
+                                     for kind in entry['sections']])
+        catalog.append(image)
+
+    fd, fn = tempfile.mkstemp(dir = directory)
+    f = os.fdopen(fd, 'w+b')
+    try:
+        prettyprint(catalog, f, width = 78)
+    finally:
+        f.close()
+    try:
+        shutil.move(fn, _catalog_path(directory))
+    except:
+        log.exception("Renaming %s to %s", fn, _catalog_path(directory))
+        os.remove(fn)
+        raise XendError("Failed to write save catalog in %s" % directory)
+
+
+def _is_image(path):
+    try:
+        f = open(path)
+        try:
+            return f.read(len(HEADER_SIGNATURE)) == HEADER_SIGNATURE
+        finally:
+            f.close()
+    except IOError:
+        return False
+
+
+def record(path):
+    """Add or refresh the catalog entry of a save image just written."""
+    directory = os.path.dirname(os.path.abspath(path))
+    entry = image_entry(path)
+    entry['created'] = int(time.time())
+    _lock.acquire()
+    try:
+        entries = _load(directory)
+        entries[entry['path']] = entry
+        _store(directory, entries)
+    finally:
+        _lock.release()
+
+
+def query(directory, grp = None):
+    """Return the catalog entries of a save directory.
+
+    Entries whose image is gone are dropped, and images that changed or
+    are missing from the catalog are indexed from their headers first.
+
+    @param grp: only images of the group with this dguuid or name
+    @rtype: list of dict
+    """
+    directory = os.path.abspath(directory)
+    if not os.path.isdir(directory):
+        raise XendError("No such save directory: %s" % directory)
+
+    _lock.acquire()
+    try:
+        entries = _load(directory)
+        changed = False
+        for name in entries.keys():
+            path = os.path.join(directory, name)
+            if not os.path.isfile(path) or \
+               int(os.stat(path).st_mtime) != entries[name]['mtime']:
+                del entries[name]
+                changed = True
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if name in entries or name == CATALOG_FILE or \
+               not os.path.isfile(path) or not _is_image(path):
+                continue
+            try:
+                entries[name] = image_entry(path)
+                changed = True
+            except XendError, exn:
+                log.warn("Not cataloguing %s: %s", path, exn)
+        if changed:
+            _store(directory, entries)
+    finally:
+        _lock.release()
+
+    result = []
+    for entry in entries.values():
+        if grp is None or str(grp) in (entry['dguuid'], entry['grp_name']):
+            entry = dict(entry)
+            entry['path'] = os.path.join(directory, entry['path'])
+            result.append(entry)
+    result.sort(key = lambda e: e['path'])
+    return result
@@ -0,0 +1,135 @@
+#########################################################################
+#									#
+#			  Xend Sxp					#
+#									#
+#########################################################################
+
+"""A fast codec for s-expressions, for the hot paths that turn domain
+configs to and from text: config load and save, and checkpoint headers.
+
+Its text is read back by sxp.Parser and it reads sxp.to_string output.
+Values decode as in sxp: lists and strings, with numbers left as
+strings.  parse() splits the text into tokens in a single findall pass
+of one compiled regex instead of a per-character state machine, and
+to_string() joins each list's text once rather than writing it a piece
+at a time.
+
+XendSxpBenchmark compares it with the sxp module.
+"""
+
+import re
+import types
+
+from xen.xend.XendError import XendError
+
+# one token per match: open, close, quoted string, atom, or anything
+# else, which is an error; comments match no group
+TOKEN = re.compile(r"""\s*(?:
+      (\()
+    | (\))
+    | ("(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+    | ;[^\n]*
+    | ([^\s()"';]+)
+    | (\S)
+    )""", re.X | re.S)
+
+# strings written bare; everything else is quoted
+ATOM = re.compile(r"^[A-Za-z0-9_.:/@~+-]+\Z")
+
+PRETTY_INDENT = 4
+
+
+def _unquote(s):
+    s = s[1:-1]
+    if '\\' in s:
+        return s.decode('string_escape')
+    return s
+
+
+def parse(text):
+    """Parse every value in text.
+
+    @rtype: list
+    @raise XendError: unbalanced parentheses or unterminated string
+    """
+    stack = [[]]
+    current = stack[0]
+    for lparen, rparen, quoted, atom, bad in TOKEN.findall(text):
+        if atom:
+            current.append(atom)
+        elif lparen:
+            value = []
+            current.append(value)
+            stack.append(value)
+            current = value
+        elif rparen:
+            if len(stack) == 1:
+                raise XendError("sxp parse error: unbalanced ')'")
+            stack.pop()
+            current = stack[-1]
+        elif quoted:
+            current.append(_unquote(quoted))
+        elif bad:
+            raise XendError("sxp parse error at '%s'" % bad)
+    if len(stack) != 1:
+        raise XendError("sxp parse error: %d unclosed lists" %
+                        (len(stack) - 1))
+    return stack[0]
+
+
+def from_string(text):
+    """@return: the first value in text, None if there is none"""
+    values = parse(text)
+    if values:
+        return values[0]
+    return None
+
+
+LIST_TYPES = (types.ListType, types.TupleType)
+NUMBER_TYPES = (types.IntType, types.LongType, types.FloatType)
+
+
+def _atom(x):
+    if isinstance(x, types.StringType):
+        if ATOM.match(x):
+            return x
+        return repr(x)
+    if isinstance(x, NUMBER_TYPES):
+        return str(x)
+    if isinstance(x, types.UnicodeType):
+        return _atom(x.encode('utf-8'))
+    return repr(x)
+
+
+def to_string(sxpr):
+    """@return: sxpr as text on one line
+    @rtype: string
+    """
+    if isinstance(sxpr, LIST_TYPES):
+        return '(' + ' '.join([to_string(x) for x in sxpr]) + ')'
+    return _atom(sxpr)
+
+
+def _pretty(sxpr, indent):
+    if not isinstance(sxpr, LIST_TYPES):
+        return _atom(sxpr)
+    for x in sxpr:
+        if isinstance(x, LIST_TYPES):
+            break
+    else:
+        return to_string(sxpr)
+    inner = indent + PRETTY_INDENT
+    if sxpr and not isinstance(sxpr[0], LIST_TYPES):
+        head = [_atom(sxpr[0])]
+        sxpr = sxpr[1:]
+    else:
+        head = []
+    return '(' + ('\n' + ' ' * inner).join(
+        head + [_pretty(x, inner) for x in sxpr]) + ')'
+
+
+def pretty(sxpr):
+    """@return: sxpr as text with one nested list per line
+    @rtype: string
+    """
+    return _pretty(sxpr, 0) + '\n'
@@ -0,0 +1,122 @@
+#########################################################################
+#									#
+#			  Xend Sxp Benchmark				#
+#									#
+#########################################################################
+
+"""Compares XendSxp with the sxp module on a domain config as
+XendConfig.to_sxp builds it: checks that both codecs agree, then prints
+the mean time of each step.  Not used by xend; run it by hand:
+
+    python -m xen.xend.XendSxpBenchmark [rounds] [devices]
+"""
+
+import sys
+import time
+import types
+from StringIO import StringIO
+
+from xen.xend import sxp
+from xen.xend import XendSxp
+
+
+def sample_config(nr_devices = 30):
+    """A domain config as XendConfig.to_sxp builds it, with nr_devices
+    devices split between disks and network interfaces."""
+    config = ['domain',
+              ['domid', 12],
+              ['uuid', 'b1e4c1b6-9a4f-4d0e-8d7c-5a5b7e0e0c3a'],
+              ['name', 'bench-guest'],
+              ['memory', 2048],
+              ['maxmem', 2048],
+              ['vcpus', 4],
+              ['on_poweroff', 'destroy'],
+              ['on_reboot', 'restart'],
+              ['on_crash', 'restart'],
+              ['cpu_weight', 256],
+              ['cpu_cap', 0],
+              ['bootloader', '/usr/bin/pygrub'],
+              ['description', 'bench guest (30 devices), "quoted"'],
+              ['image', ['linux',
+                         ['kernel', '/boot/vmlinuz-2.6.18-xen'],
+                         ['ramdisk', '/boot/initrd-2.6.18-xen.img'],
+                         ['args', 'root=/dev/xvda1 ro console=hvc0 quiet'],
+                         ['notes', ['HV_START_LOW', 4118806528],
+                                   ['FEATURES', 'writable_page_tables|'
+                                    'writable_descriptor_tables'],
+                                   ['PAE_MODE', 'yes']]]],
+              ['cpu_time', 1234.5678],
+              ['online_vcpus', 4],
+              ['start_time', 1287342341.21]]
+    for i in range(nr_devices):
+        if i % 2:
+            config.append(['device',
+                           ['vif',
+                            ['bridge', 'xenbr%d' % (i % 3)],
+                            ['mac', '00:16:3e:%02x:%02x:%02x' % (i, i, i)],
+                            ['script', '/etc/xen/scripts/vif-bridge'],
+                            ['uuid', '5e0d2a34-7c1f-4b0e-9a3d-%012x' % i],
+                            ['backend', 0]]])
+        else:
+            config.append(['device',
+                           ['vbd',
+                            ['uname', 'phy:/dev/vg0/guest-disk%d' % i],
+                            ['dev', 'xvd%s:disk' % chr(ord('a') + i / 2)],
+                            ['mode', 'w'],
+                            ['uuid', '9c8b7a65-4d3e-2f10-a9b8-%012x' % i],
+                            ['bootable', int(i == 0)],
+                            ['backend', 0]]])
+    return config
+
+
+def _stringify(sxpr):
+    """sxpr as it reads back: every atom a string."""
+    if isinstance(sxpr, XendSxp.LIST_TYPES):
+        return map(_stringify, sxpr)
+    if isinstance(sxpr, types.StringType):
+        return sxpr
+    return str(sxpr)
+
+
+def mean_us(fn, arg, rounds):
+    """@return: mean time of fn(arg) over rounds calls, in microseconds"""
+    started = time.time()
+    for _ in xrange(rounds):
+        fn(arg)
+    return (time.time() - started) / rounds * 1e6
+
+
+def _sxp_parse(text):
+    return sxp.parse(StringIO(text))
+
+
+def benchmark(rounds = 2000, nr_devices = 30):
+    """Round-trip a domain config with both codecs, check they agree,
+    and print the mean time of each step in microseconds.
+
+    @return: (step, sxp time, XendSxp time) per step
+    @rtype: list of tuple
+    """
+    config = sample_config(nr_devices)
+    text = XendSxp.to_string(config)
+    expected = _stringify(config)
+
+    assert XendSxp.parse(text) == [expected]
+    assert XendSxp.parse(XendSxp.pretty(config)) == [expected]
+    assert _sxp_parse(text) == [expected]
+    assert XendSxp.parse(sxp.to_string(config)) == [expected]
+
+    results = [('to_string', mean_us(sxp.to_string, config, rounds),
+                mean_us(XendSxp.to_string, config, rounds)),
+               ('parse', mean_us(_sxp_parse, text, rounds),
+                mean_us(XendSxp.parse, text, rounds))]
+    print "%d byte config, %d devices, %d rounds" % (len(text), nr_devices,
+                                                     rounds)
+    print "%-10s %12s %12s %8s" % ('', 'sxp (us)', 'XendSxp (us)', 'speedup')
+    for name, old, new in results:
+        print "%-10s %12.1f %12.1f %7.1fx" % (name, old, new, old / new)
+    return results
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:3]))
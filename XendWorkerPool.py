@@ -0,0 +1,81 @@
+#========================================================================
+#
+#		Xend_Worker_Pool
+#
+#========================================================================
+
+"""Runs an operation on every item of a list over a bounded pool of
+worker threads, and reports the outcome for each item.
+"""
+
+import Queue
+import threading
+import time
+
+from xen.xend.XendLogging import log
+
+
+def member_result(name, ok, error, started):
+    """Build the result reported for one item.
+
+    @param name: item name
+    @param ok: whether the operation succeeded
+    @param error: error message, '' on success
+    @param started: time.time() at which the operation started
+    @rtype: dict
+    """
+    return {'member': name,
+            'ok': bool(ok),
+            'error': error,
+            'elapsed_ms': int((time.time() - started) * 1000)}
+
+
+class XendWorkerPool:
+    """Fans an operation out over at most max_workers threads.
+
+    @ivar max_workers: upper bound on concurrently running operations
+    @type max_workers: int
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max(1, int(max_workers))
+
+    def run(self, items, op, name = str, what = "Operation"):
+        """Call op(item) for every item and wait for all of them.
+
+        @param items: work items, started in the given order
+        @type items: list
+        @param op: callable run once per item; an exception marks the
+                   item as failed
+        @param name: callable giving the name of an item
+        @param what: the operation, as named in the log when an item fails
+        @return: one L{member_result} per item, in the order of items
+        @rtype: list of dict
+        """
+        work = Queue.Queue()
+        for i, item in enumerate(items):
+            work.put((i, item))
+        results = [None] * len(items)
+
+        def worker():
+            while True:
+                try:
+                    i, item = work.get_nowait()
+                except Queue.Empty:
+                    return
+                started = time.time()
+                try:
+                    op(item)
+                    results[i] = member_result(name(item), True, '', started)
+                except Exception, exn:
+                    log.exception("%s failed on %s", what, name(item))
+                    results[i] = member_result(name(item), False, str(exn),
+                                               started)
+
+        threads = [threading.Thread(target = worker)
+                   for _ in range(min(self.max_workers, len(items)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
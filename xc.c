@@ -1834,6 +1834,9 @@ static PyObject *pyxc_dom_set_memshr(XcObject *self, PyObject *args)
     return zero;
 }
 
+/* number of groups fetched per xc_domain_group_getinfo call */
+#define GRPINFO_CHUNK 64
+
 #define EXTRACT_DOM_LIST(list_name, dict)                              \
         dom_list = PyList_New(0);                                      \
         for ( j = 0; j < info[i].size; j++ )                           \
@@ -1855,8 +1858,8 @@ static PyObject *pyxc_domain_group_getinfo(XcObject *self,
 
     uint32_t first_grp = 0;
    
-    int max_grps = NULL_GROUP_ID+1, nr_grps, i, j;
-    xc_grpinfo_t *info;
+    int max_grps = -1, nr_grps = 0, nr_alloc, want, rc, i, j;
+    xc_grpinfo_t *info, *new_info;
 
     static char *kwd_list[] = { "first_grp", "max_grps", NULL };
 
@@ -1865,17 +1868,55 @@ static PyObject *pyxc_domain_group_getinfo(XcObject *self,
                                       &first_grp, &max_grps) )
         return NULL;
 
-    /* alloc space for the group info and ask Xen (via libxc) for the info */
-    if ( (info = malloc(max_grps * sizeof(xc_grpinfo_t))) == NULL )
+    /* 
+     * Without max_grps, return every group from first_grp on.  The buffer
+     * starts small and grows with the number of groups that actually
+     * exist, rather than covering the whole group id space.
+     */
+    nr_alloc = GRPINFO_CHUNK;
+    if ( max_grps >= 0 && max_grps < nr_alloc )
+        nr_alloc = max_grps ? max_grps : 1;
+
+    if ( (info = malloc(nr_alloc * sizeof(xc_grpinfo_t))) == NULL )
         return PyErr_NoMemory();
 
-	/* put domain group info into nr_grps by xc_domain_group.c  */
-    nr_grps = xc_domain_group_getinfo(self->xc_handle, first_grp, max_grps, info);
+    for ( ; ; )
+    {
+        want = GRPINFO_CHUNK;
+        if ( max_grps >= 0 && want > max_grps - nr_grps )
+            want = max_grps - nr_grps;
+        if ( want <= 0 )
+            break;
 
-    if (nr_grps < 0) 
-	{
-        free(info);
-        return PyErr_SetFromErrno(xc_error_obj);
+        if ( nr_grps + want > nr_alloc )
+        {
+            nr_alloc = nr_alloc * 2 > nr_grps + want ?
+                       nr_alloc * 2 : nr_grps + want;
+            if ( (new_info = realloc(info, nr_alloc * sizeof(xc_grpinfo_t)))
+                 == NULL )
+            {
+                free(info);
+                return PyErr_NoMemory();
+            }
+            info = new_info;
+        }
+
+        /* put domain group info into info by xc_domain_group.c  */
+        rc = xc_domain_group_getinfo(self->xc_handle, first_grp, want,
+                                     info + nr_grps);
+        if ( rc < 0 )
+        {
+            /* running off the end of the group list is not an error */
+            if ( nr_grps )
+                break;
+            free(info);
+            return PyErr_SetFromErrno(xc_error_obj);
+        }
+
+        nr_grps += rc;
+        if ( rc < want )
+            break;
+        first_grp = info[nr_grps - 1].dgid + 1;
     }
 
     /* iterate the returned groups(nr_grps) and 
@@ -2181,14 +2222,15 @@ static PyMethodDef pyxc_methods[] = {
       METH_VARARGS | METH_KEYWORDS, "\n"
       "Get information regarding a set of domain groups.\n"
       " first_grp [int, 0]:    First domain to retrieve info about.\n"
-      " max_grps  [int, 1024]: Maximum number of domains to retrieve info"
+      " max_grps  [int, all]:  Maximum number of domains to retrieve info"
       " about.\n\n"
       "Returns:  [list of dicts] if list length is less than 'max_grps'\n"
       "          parameter then there was an error, or the end of the\n"
       "          group-id space was reached.\n"
       " grp               [int]: Id of group to which this info pertains\n"
       " size              [int]: Number of domains in this group\n"
-      " member_list       [int array]: Unordered list of member Ids\n"},
+      " member_list       [int array]: Unordered list of member Ids\n"
+      " dg_handle         [int array]: Group handle (uuid bytes)\n"},
 
 
     { "vcpu_getinfo", 